@@ -0,0 +1,336 @@
+# HTTP client for the API server (api/app.py), shared by the Streamlit UI and by
+# scripts that call the API in bulk.
+#   - One pooled httpx client per ApiClient / AsyncApiClient: keep-alive connections
+#     are reused across calls instead of a new TCP connection per request.
+#   - Timeouts on every call (connect, read, write, pool wait); failed connection
+#     attempts are retried by the transport, nothing else is.
+#   - Responses may be compressed: httpx asks for gzip/deflate (and zstd when the
+#     zstandard package is installed) and decodes them transparently.
+#   - Failures raise typed errors (below) instead of returning error strings.
+#
+#   with ApiClient("http://localhost:8000") as api:
+#       api.essay("monsoon", 100)["essay"]
+#
+#   async with AsyncApiClient("http://localhost:8000") as api:
+#       results = await api.map(lambda topic: api.poem(topic, 30), topics, concurrency=16)
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+
+# -------------------------------
+# Errors
+# -------------------------------
+class ApiError(Exception):
+    pass
+
+
+# The server could not be reached or the connection dropped
+class ApiConnectionError(ApiError):
+    pass
+
+
+class ApiTimeout(ApiError):
+    pass
+
+
+# The server answered with an unexpected HTTP status
+class ApiStatusError(ApiError):
+    def __init__(self, status_code, message):
+        super().__init__(f"HTTP {status_code}: {message}")
+        self.status_code = status_code
+
+
+# 503 from the upstream scheduler or the job queue; retry after `retry_after` seconds
+class ServerBusy(ApiStatusError):
+    def __init__(self, status_code, message, retry_after=None):
+        super().__init__(status_code, message)
+        self.retry_after = retry_after
+
+
+# The server answered 200 but reported an error in the body ({"error": ...})
+class ApiResponseError(ApiError):
+    pass
+
+
+DEFAULT_TIMEOUT = httpx.Timeout(connect=5.0, read=120.0, write=30.0, pool=10.0)
+DEFAULT_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0)
+
+
+def check_status(response, expected=(200,)):
+    if response.status_code in expected:
+        return
+    try:
+        message = response.json().get("error") or response.json().get("detail") or response.text
+    except (ValueError, AttributeError):
+        message = response.text
+    if response.status_code == 503:
+        retry_after = response.headers.get("retry-after")
+        raise ServerBusy(response.status_code, message, int(retry_after) if retry_after and retry_after.isdigit() else None)
+    raise ApiStatusError(response.status_code, message)
+
+
+def decode(response, expected=(200,)):
+    check_status(response, expected)
+    try:
+        data = response.json()
+    except ValueError:
+        raise ApiResponseError("Response is not JSON")
+    if isinstance(data, dict) and "error" in data:
+        raise ApiResponseError(data["error"])
+    return data
+
+
+def translate(exc):
+    if isinstance(exc, httpx.TimeoutException):
+        return ApiTimeout(str(exc) or "Request timed out")
+    return ApiConnectionError(str(exc) or type(exc).__name__)
+
+
+# Server-Sent-Events lines -> (event, data) pairs
+class SseParser:
+    def __init__(self):
+        self.event, self.data = "message", []
+
+    def feed(self, line):
+        if not line:
+            return self.flush()
+        if line.startswith("event:"):
+            self.event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            self.data.append(line[len("data:"):].strip())
+        return None
+
+    def flush(self):
+        item = (self.event, json.loads("\n".join(self.data))) if self.data else None
+        self.event, self.data = "message", []
+        return item
+
+
+# httpx sends a None param as an empty value (`conversation_id=`); leave those out
+def drop_none(kwargs):
+    if isinstance(kwargs.get("params"), dict):
+        kwargs["params"] = {k: v for k, v in kwargs["params"].items() if v is not None}
+    return kwargs
+
+
+def job_params(params):
+    return {**params, "mode": "job"}
+
+
+# -------------------------------
+# Sync client
+# -------------------------------
+class ApiClient:
+    def __init__(self, base_url=None, timeout=DEFAULT_TIMEOUT, limits=DEFAULT_LIMITS, retries=2, transport=None):
+        self.http = httpx.Client(
+            base_url=base_url or os.getenv("API_BASE_URL", "http://localhost:8000"),
+            timeout=timeout,
+            transport=transport or httpx.HTTPTransport(limits=limits, retries=retries),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.http.close()
+
+    def request(self, method, path, expected=(200,), **kwargs):
+        try:
+            response = self.http.request(method, path, **drop_none(kwargs))
+        except httpx.HTTPError as e:
+            raise translate(e)
+        return decode(response, expected)
+
+    # Yields (event, data) pairs from a Server-Sent-Events endpoint
+    def stream(self, method, path, **kwargs):
+        parser = SseParser()
+        try:
+            with self.http.stream(method, path, **drop_none(kwargs)) as response:
+                if response.status_code != 200:
+                    response.read()
+                    check_status(response)
+                for line in response.iter_lines():
+                    item = parser.feed(line)
+                    if item is not None:
+                        yield item
+        except httpx.HTTPError as e:
+            raise translate(e)
+        item = parser.flush()
+        if item is not None:
+            yield item
+
+    # Yields the objects of an NDJSON response (batches with stream=true, streams with format=ndjson)
+    def ndjson(self, method, path, **kwargs):
+        try:
+            with self.http.stream(method, path, **drop_none(kwargs)) as response:
+                if response.status_code != 200:
+                    response.read()
+                    check_status(response)
+                for line in response.iter_lines():
+                    if line:
+                        yield json.loads(line)
+        except httpx.HTTPError as e:
+            raise translate(e)
+
+    def companion(self, prompt, conversation_id=None, context=""):
+        return self.request("POST", "/companion",
+                            params={"prompt": prompt, "conversation_id": conversation_id, "context": context})
+
+    def seed_memory(self, conversation_id, summaries):
+        return self.request("PUT", f"/companion/memory/{conversation_id}", json=summaries)
+
+    def delete_memory(self, conversation_id):
+        return self.request("DELETE", f"/companion/memory/{conversation_id}")
+
+    # kind is "essay" or "poem"
+    def text(self, kind, topic, length):
+        return self.request("GET", f"/{kind}", params={"topic": topic, "length": length})
+
+    def essay(self, topic, length=100):
+        return self.text("essay", topic, length)
+
+    def poem(self, topic, length=30):
+        return self.text("poem", topic, length)
+
+    def generate_image(self, prompt, num_images=2):
+        return self.request("GET", "/generate-image", params={"prompt": prompt, "num_images": num_images})
+
+    # Queue a job on /essay, /poem or /generate-image; returns the job id
+    def submit_job(self, endpoint, params):
+        return self.request("GET", f"/{endpoint}", expected=(202,), params=job_params(params))["job_id"]
+
+    def job(self, job_id, wait=0):
+        return self.request("GET", f"/jobs/{job_id}", params={"wait": wait}, timeout=DEFAULT_TIMEOUT.connect + wait + 10)
+
+    # Long-poll until the job is done or failed and return it; ApiTimeout after `timeout` seconds
+    def wait_for_job(self, job_id, timeout=600, poll=25):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                job = self.job(job_id, wait=min(poll, max(0, int(deadline - time.monotonic()))))
+            except ApiConnectionError:
+                time.sleep(1)
+                continue
+            if job["status"] in ("done", "failed"):
+                return job
+        raise ApiTimeout(f"Job {job_id} did not finish within {timeout}s")
+
+
+# -------------------------------
+# Async client
+# -------------------------------
+# Same calls as ApiClient, awaitable, for firing many requests concurrently.
+class AsyncApiClient:
+    def __init__(self, base_url=None, timeout=DEFAULT_TIMEOUT, limits=DEFAULT_LIMITS, retries=2, transport=None):
+        self.http = httpx.AsyncClient(
+            base_url=base_url or os.getenv("API_BASE_URL", "http://localhost:8000"),
+            timeout=timeout,
+            transport=transport or httpx.AsyncHTTPTransport(limits=limits, retries=retries),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.http.aclose()
+
+    async def request(self, method, path, expected=(200,), **kwargs):
+        try:
+            response = await self.http.request(method, path, **drop_none(kwargs))
+        except httpx.HTTPError as e:
+            raise translate(e)
+        return decode(response, expected)
+
+    async def stream(self, method, path, **kwargs):
+        parser = SseParser()
+        try:
+            async with self.http.stream(method, path, **drop_none(kwargs)) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    check_status(response)
+                async for line in response.aiter_lines():
+                    item = parser.feed(line)
+                    if item is not None:
+                        yield item
+        except httpx.HTTPError as e:
+            raise translate(e)
+        item = parser.flush()
+        if item is not None:
+            yield item
+
+    async def ndjson(self, method, path, **kwargs):
+        try:
+            async with self.http.stream(method, path, **drop_none(kwargs)) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    check_status(response)
+                async for line in response.aiter_lines():
+                    if line:
+                        yield json.loads(line)
+        except httpx.HTTPError as e:
+            raise translate(e)
+
+    async def companion(self, prompt, conversation_id=None, context=""):
+        return await self.request("POST", "/companion",
+                                  params={"prompt": prompt, "conversation_id": conversation_id, "context": context})
+
+    async def seed_memory(self, conversation_id, summaries):
+        return await self.request("PUT", f"/companion/memory/{conversation_id}", json=summaries)
+
+    async def delete_memory(self, conversation_id):
+        return await self.request("DELETE", f"/companion/memory/{conversation_id}")
+
+    async def text(self, kind, topic, length):
+        return await self.request("GET", f"/{kind}", params={"topic": topic, "length": length})
+
+    async def essay(self, topic, length=100):
+        return await self.text("essay", topic, length)
+
+    async def poem(self, topic, length=30):
+        return await self.text("poem", topic, length)
+
+    async def generate_image(self, prompt, num_images=2):
+        return await self.request("GET", "/generate-image", params={"prompt": prompt, "num_images": num_images})
+
+    async def submit_job(self, endpoint, params):
+        return (await self.request("GET", f"/{endpoint}", expected=(202,), params=job_params(params)))["job_id"]
+
+    async def job(self, job_id, wait=0):
+        return await self.request("GET", f"/jobs/{job_id}", params={"wait": wait},
+                                  timeout=DEFAULT_TIMEOUT.connect + wait + 10)
+
+    async def wait_for_job(self, job_id, timeout=600, poll=25):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                job = await self.job(job_id, wait=min(poll, max(0, int(deadline - time.monotonic()))))
+            except ApiConnectionError:
+                await asyncio.sleep(1)
+                continue
+            if job["status"] in ("done", "failed"):
+                return job
+        raise ApiTimeout(f"Job {job_id} did not finish within {timeout}s")
+
+    # Run `call(item)` for every item with at most `concurrency` in flight; results
+    # come back in input order, failed calls as their ApiError
+    async def map(self, call, items, concurrency=8):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(item):
+            async with semaphore:
+                try:
+                    return await call(item)
+                except ApiError as e:
+                    return e
+
+        return await asyncio.gather(*(run(item) for item in items))
@@ -1,9 +1,15 @@
+import time  # Timing of upstream calls and of the startup phases
+IMPORT_START = time.perf_counter()
+
 # FastAPI is a modern, fast (high-performance), web framework for building APIs with Python 3.6+ based on standard Python type hints.
-from fastapi import FastAPI, Query  # Main FastAPI class and query parameter handling
+from fastapi import FastAPI, APIRouter, Query, Body, HTTPException  # Main FastAPI class, routes, parameter handling and errors
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse, ORJSONResponse  # NDJSON, /metrics, 503s, default
+from sse_starlette.sse import EventSourceResponse  # Server-Sent-Events responses for the streaming endpoints
+from pydantic import BaseModel, Field  # Request bodies for the batch endpoints
 
 
-from langchain.prompts import ChatPromptTemplate  # For building prompt templates for LLMs
-from langchain_google_genai import ChatGoogleGenerativeAI  # Gemini model integration for LangChain
+# LangChain (ChatPromptTemplate, RunnableLambda) and the model backend are imported
+# lazily, on first use or during warm-up, so importing this module stays fast.
 # from langserve import add_routes  # Utility to expose LangChain chains as API endpoints
 
 # UVicorn is an ASGI server used to run FastAPI applications, handling HTTP requests asynchronously.
@@ -11,158 +17,944 @@ from langchain_google_genai import ChatGoogleGenerativeAI  # Gemini model integr
 import uvicorn  # ASGI server to run FastAPI apps
 
 import os  # OS operations (env vars, paths)
+import logging  # Startup report and background-task warnings
+import orjson  # Fast JSON encoding of the responses and of streamed events
+import asyncio  # Concurrency primitives for the async model calls
+import functools  # Cached lazy construction of the model, chains and templates
+from contextlib import asynccontextmanager  # Startup (warm-up) hook of the app
 from dotenv import load_dotenv  # Loads environment variables from .env file
 
+from cache import cache_from_env, make_key, template_version  # Response cache for /essay and /poem
+from semantic_cache import semantic_cache_from_env, make_scope  # Near-duplicate cache for /companion and /generate-image
+from singleflight import SingleFlight  # Coalesces identical in-flight generations
+from memory import memory_from_env, safe_id  # Server-side conversation memory for /companion
+from retrieval import retrieval_from_env, embedder_from_env  # Embedding-based retrieval memory for /companion
+from metrics import (  # Prometheus-style instrumentation served at /metrics
+    MetricsMiddleware, registry, stage, record_upstream, record_cache, record_error, record_parse, classify_error, watch_scheduler,
+    watch_resilience, current_endpoint, current_request, RequestTiming, startup,
+)
+from scheduler import scheduler_from_env, SchedulerBusy, INTERACTIVE, BULK  # Rate limits, adaptive concurrency, priorities
+from resilience import caller_from_env  # Deadlines, retries and hedging for upstream calls
+from jobs import jobs_from_env, JobQueueFull  # Background jobs for long generations
+from shared_state import LazyStore, shared_state_enabled  # State shared by all worker processes (see serve.py)
+from capture import capture_from_env, CaptureMiddleware  # Opt-in traffic capture for bench/replay.py
+from compression import compression_from_env, CompressionMiddleware  # Negotiated zstd/gzip response compression
+from structured import (  # JSON-schema replies for /companion and /generate-image
+    CompanionReply, ImagePrompts, structured_runnable, parse_structured, message_text, raw_message, JsonFieldStream,
+)
 
+startup.mark("imports", IMPORT_START)
 
+# GOOGLE_API_KEY is read from the environment (or .env) by the Gemini client itself
 load_dotenv()
-os.environ['GOOGLE_API_KEY'] = os.getenv('GOOGLE_API_KEY')
 
-app = FastAPI(
-    title="Langchain Server",
-    version="1.0",
-    description="A simple API Server with Gemini"
-)
+# Uvicorn only configures its own loggers, so give the app's (this module, scheduler,
+# jobs) a handler unless logging is already set up. Other libraries stay at WARNING;
+# this module logs at LOG_LEVEL.
+logging.basicConfig(format="%(levelname)s:     %(name)s - %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+# With several worker processes, rate-limit counters, job records and (with Redis)
+# the response cache live in a store shared by all of them (STATE_BACKEND in .env,
+# see shared_state.py); a single worker keeps them in process memory. serve.py sets
+# SERVER_WORKERS so per-process limits can be split between workers. The store is
+# opened by the lifespan hook in create_app(), not at import.
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+state_store = LazyStore() if shared_state_enabled(SERVER_WORKERS) else None
+
+# Routes are registered on this router and mounted by create_app() at the bottom
+router = APIRouter()
 
 # -------------------------------
 # Gemini Model
 # -------------------------------
-model = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+# MODEL_BACKEND=fake swaps Gemini for a local fake model (see backends.py) so the
+# server can be load-tested without spending quota. The client is built on first
+# use (or during warm-up) and then reused.
+MODEL_NAME = "gemini-1.5-flash"
+
+@functools.cache
+def get_model():
+    with startup.phase("model"):
+        from backends import create_model  # Gemini or the offline fake backend (MODEL_BACKEND in .env)
+        return create_model(MODEL_NAME)
+
+# -------------------------------
+# Upstream scheduling
+# -------------------------------
+# Every endpoint awaits the model with .ainvoke() so the event loop keeps serving
+# other requests during the Gemini round trip. Each call first takes a permit from
+# the scheduler (see scheduler.py): requests/tokens per minute (UPSTREAM_RPM,
+# UPSTREAM_TPM), an adaptive concurrency window capped at MAX_CONCURRENCY, and a
+# bounded priority queue (QUEUE_MAX, QUEUE_TIMEOUT) in which interactive calls go
+# before bulk ones. A full queue answers 503 with Retry-After.
+#
+# Time spent waiting for a permit is recorded as the "queue" stage and the call
+# itself as "upstream", together with its token usage (see metrics.py).
+EXPECTED_COMPLETION_TOKENS = int(os.getenv("EXPECTED_COMPLETION_TOKENS", "400"))
+scheduler = scheduler_from_env(state_store, SERVER_WORKERS)
+watch_scheduler(scheduler)
+
+# Tokens charged against UPSTREAM_TPM before the call; settled with the real usage after
+def estimate_cost(payload):
+    return (len(str(payload)) + 3) // 4 + EXPECTED_COMPLETION_TOKENS
+
+def total_tokens(response):
+    usage = getattr(raw_message(response), "usage_metadata", None)
+    return usage.get("total_tokens") if usage else None
+
+async def call_model_once(runnable, payload, priority=BULK):
+    with stage("queue"):
+        permit = await scheduler.acquire(priority, estimate_cost(payload))
+    response = error = None
+    cancelled = False
+    start = time.perf_counter()
+    try:
+        with stage("upstream"):
+            response = await runnable.ainvoke(payload)
+        return response
+    except asyncio.CancelledError:
+        # A hedge loser or a call cut off at its deadline: its latency says nothing about upstream
+        cancelled = True
+        raise
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        latency = None if cancelled else time.perf_counter() - start
+        scheduler.release(permit, latency=latency, error=error, tokens_used=total_tokens(response))
+        if latency is not None:
+            record_upstream(latency, raw_message(response))
+
+# -------------------------------
+# Deadlines, retries and hedging
+# -------------------------------
+# call_model wraps call_model_once with a deadline (UPSTREAM_DEADLINE, or the
+# `deadline` query parameter), jittered retries of idempotent failures
+# (UPSTREAM_RETRIES) and, with HEDGE_REQUESTS=1, a second attempt when the first
+# is slower than the endpoint's observed p95. Each attempt takes its own permit.
+resilient = caller_from_env()
+watch_resilience(resilient)
+
+async def call_model(runnable, payload, priority=BULK, deadline=None):
+    return await resilient.call(
+        lambda: call_model_once(runnable, payload, priority), key=current_endpoint(), deadline=deadline
+    )
+
+# Same as call_model_once, but yields the text of each chunk as the model produces it.
+# Generation time depends on the reply length, so it does not feed the latency-based
+# window adjustments (429s still do).
+async def stream_model(runnable, payload, priority=BULK):
+    with stage("queue"):
+        permit = await scheduler.acquire(priority, estimate_cost(payload))
+    usage = {"input_tokens": 0, "output_tokens": 0}
+    error = None
+    start = time.perf_counter()
+    try:
+        with stage("upstream"):
+            async for chunk in runnable.astream(payload):
+                for name in usage:
+                    usage[name] += (getattr(chunk, "usage_metadata", None) or {}).get(name, 0)
+                if chunk.content:
+                    yield chunk.content
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        from langchain_core.messages import AIMessage  # Carries token usage of streamed calls to the metrics
+        response = AIMessage(content="", usage_metadata={**usage, "total_tokens": sum(usage.values())})
+        scheduler.release(permit, error=error, tokens_used=total_tokens(response) or None)
+        record_upstream(time.perf_counter() - start, response)
+
+# Streaming endpoints check up front so a full queue is a plain 503 instead of an error event
+def check_capacity():
+    if scheduler.is_full():
+        raise SchedulerBusy(scheduler.retry_after())
+
+async def scheduler_busy(request, exc):
+    record_error("server_busy")
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Server busy, please retry later."},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+# The model as a chain step that goes through call_model, for chains that LangChain
+# runs itself (e.g. .abatch), so those calls also respect the upstream limit.
+async def limited_model_call(messages):
+    return await call_model(get_model(), messages)
+
+# Prompt templates and prompt | model chains are built once per template and reused
+@functools.cache
+def get_template(template):
+    from langchain_core.prompts import ChatPromptTemplate  # For building prompt templates for LLMs
+    return ChatPromptTemplate.from_template(template)
+
+@functools.cache
+def text_chain(template):
+    return get_template(template) | get_model()
+
+@functools.cache
+def batch_chain(template):
+    from langchain_core.runnables import RunnableLambda  # Wraps the rate-limited model call as a chain step
+    return get_template(template) | RunnableLambda(limited_model_call)
 
 # Basic chat endpoint
 # This endpoint exposes the Gemini model at /gemini/invoke
 # add_routes(app, model, path="/gemini")
 
 # -------------------------------
-# Companion endpoint
+# Prompts and output parsing
 # -------------------------------
-@app.post("/companion")
-async def companion(prompt: str, context: str = ""):
-    try:
-        # Single Gemini call: ask for answer and 25-word summary
-        full_prompt = (
+ESSAY_TEMPLATE = (
+    "Write an engaging and informative essay about {topic} in approximately {length} words. "
+    "Use clear, simple language so that readers of all ages can enjoy and understand it. "
+    "Organize the essay with a brief introduction, a well-structured body, and a thoughtful conclusion. "
+    "Make the content interesting and easy to read."
+)
+
+POEM_TEMPLATE = (
+    "Write a creative and heartwarming poem about {topic} in approximately {length} words. "
+    "Use simple, relatable language and imagery that resonates with Indian culture and everyday life. "
+    "Ensure the poem has a pleasant rhyme scheme and is enjoyable to read for all ages. "
+    "Make the poem emotionally engaging and easy to understand."
+)
+
+# With STRUCTURED_OUTPUT=1 (default) /companion and /generate-image ask for a JSON
+# object (see structured.py); with 0 they use the original plain-text formats.
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "1") == "1"
+
+# Single Gemini call: ask for answer and 25-word summary
+def build_companion_prompt(prompt, context):
+    if STRUCTURED_OUTPUT:
+        output_format = (
+            "4. After answering, summarize this new Q&A in exactly 25 words.\n"
+            "5. The summary must capture both the user’s request and your response so it can be stored as future memory.\n"
+            'Reply with only a JSON object: {"answer": "<your answer>", "summary": "<the 25-word summary>"}\n'
+        )
+    else:
+        output_format = (
+            "4. After answering, summarize this new Q&A in exactly 25 words, prefixed with 'SUMMARY:'.\n"
+            "5. The summary must capture both the user’s request and your response so it can be stored as future memory.\n"
+        )
+    return (
     f"Conversation History (Memory):\n{context}\n\n"
     f"User Prompt:\n{prompt}\n\n"
     "Instructions:\n"
     "1. Use the above conversation history as authoritative memory to answer the user.\n"
     "2. If the memory contains the needed information (e.g., names, numbers, past facts), use it directly.\n"
     "3. If the memory does not contain the requested information, generate a fresh answer based on your reasoning.\n"
-    "4. After answering, summarize this new Q&A in exactly 25 words, prefixed with 'SUMMARY:'.\n"
-    "5. The summary must capture both the user’s request and your response so it can be stored as future memory.\n"
+    + output_format
 )
 
-        response_obj = model.invoke(full_prompt)
-        output = response_obj.content
+def build_image_request(prompt, num_images):
+    request = f"Generate {num_images} distinct image generation prompts for Pollinations AI based on: '{prompt}'. "
+    if STRUCTURED_OUTPUT:
+        return request + 'Reply with only a JSON object: {"prompts": ["<first prompt>", "<second prompt>", ...]}'
+    return request + "Return them as a numbered list."
+
+def is_api_key_error(output):
+    return "API key not valid" in output or "Please pass a valid API key" in output
+
+# Split answer and summary
+def split_summary(output):
+    lines = output.splitlines()
+    answer_lines = []
+    context_summary = ""
+    for line in lines:
+        if line.strip().startswith("SUMMARY:"):
+            context_summary = line.strip().replace("SUMMARY:", "").strip()
+        else:
+            answer_lines.append(line)
+    answer = "\n".join(answer_lines).strip()
+    return answer, context_summary
+
+# Pick the refined prompts out of a numbered or bulleted list
+def scrape_image_prompts(output):
+    prompts = []
+    for line in output.splitlines():
+        line = line.strip()
+        if line and (line[0].isdigit() or line.startswith("-")):
+            prompt_text = line.split('.', 1)[-1].strip() if '.' in line else line.lstrip('-').strip()
+            if prompt_text:
+                prompts.append(prompt_text)
+        elif line:
+            prompts.append(line)
+    return prompts
+
+# Structured replies (function calling where the model supports it, JSON in the text
+# otherwise) are parsed first; the scrapers above are the fallback. Each reply is
+# counted in output_parse_total by method: structured, json, scraper or failed.
+@functools.cache
+def structured_model(schema):
+    return structured_runnable(get_model(), schema) if STRUCTURED_OUTPUT else get_model()
+
+def parse_companion_reply(response):
+    reply, method = parse_structured(response, CompanionReply) if STRUCTURED_OUTPUT else (None, None)
+    if reply is not None:
+        answer, context_summary = reply.answer.strip(), reply.summary.strip()
+    else:
+        answer, context_summary = split_summary(message_text(response))
+        method = "scraper"
+    record_parse(method if answer and context_summary else "failed")
+    return answer, context_summary
+
+def parse_image_prompts(response, num_images):
+    reply, method = parse_structured(response, ImagePrompts) if STRUCTURED_OUTPUT else (None, None)
+    if reply is not None:
+        prompts = [p.strip() for p in reply.prompts if p.strip()]
+    else:
+        prompts = scrape_image_prompts(message_text(response))
+        method = "scraper"
+    prompts = prompts[:num_images]
+    record_parse(method if prompts and not any(p.lower().startswith("error") for p in prompts) else "failed")
+    return prompts
+
+# -------------------------------
+# Response cache
+# -------------------------------
+# /essay and /poem are pure functions of (topic, length) plus a fixed template, so
+# repeated requests are answered from the cache (CACHE_TTL, CACHE_MAX_ENTRIES and
+# CACHE_DB in .env). Pass no_cache=true to skip the lookup and force a fresh call.
+response_cache = cache_from_env(state_store)
+
+def text_cache_key(field, template, topic, length):
+    return make_key(field, topic, length, MODEL_NAME, template_version(template))
+
+def cache_lookup(key, no_cache):
+    if no_cache:
+        response_cache.stats["bypassed"] += 1
+        record_cache("response", "bypass")
+        return None
+    value = response_cache.get(key)
+    record_cache("response", "miss" if value is None else "hit")
+    return value
+
+# Identical /essay and /poem requests that arrive while the first one is still
+# waiting on Gemini share its upstream call instead of firing their own.
+inflight = SingleFlight()
+
+# Run the chain once per cache key (shared by concurrent callers) and cache the text.
+# The shared call runs under the default deadline; a caller's own `deadline` only
+# bounds how long that caller waits, so it never cuts the call off for the others.
+async def generate_text_once(key, chain, topic, length, deadline=None):
+    async def generate():
+        response = await call_model(chain, {"topic": topic, "length": length})
+        response_cache.set(key, response.content)
+        return response.content
+    return await inflight.do(key, generate, timeout=deadline)
+
+# -------------------------------
+# Semantic cache
+# -------------------------------
+# /companion and /generate-image rarely repeat word for word, so they are cached by
+# similarity instead: a request close enough to an earlier one (per-endpoint
+# SEMANTIC_THRESHOLD_* in .env) with the same scope (model, template, context,
+# ...) reuses its result. no_cache=true skips the lookup. With the default offline
+# embedder (EMBEDDINGS=hashing) the thresholds default to 0, i.e. off.
+# Embedding (a network call with EMBEDDINGS=google) and the FAISS search run in a
+# thread, so lookups and stores don't block the event loop.
+embedder = embedder_from_env()  # Shared by the semantic cache and the retrieval memory
+semantic_cache = semantic_cache_from_env(embedder)
+
+COMPANION_VERSION = template_version(build_companion_prompt("{prompt}", "{context}"))
+
+async def semantic_lookup(endpoint, scope, text, no_cache):
+    if no_cache or not semantic_cache.enabled(endpoint):
+        record_cache(f"semantic:{endpoint}", "bypass")
+        return None
+    with stage("cache"):
+        value, _ = await asyncio.to_thread(semantic_cache.get, endpoint, scope, text)
+    record_cache(f"semantic:{endpoint}", "miss" if value is None else "hit")
+    return value
+
+async def semantic_store(endpoint, scope, text, value):
+    if semantic_cache.enabled(endpoint):
+        await asyncio.to_thread(semantic_cache.set, endpoint, scope, text, value)
+
+@router.get("/metrics")
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/cache/stats")
+async def cache_stats():
+    return {
+        **response_cache.snapshot(),
+        "singleflight": {**inflight.stats, "in_flight": inflight.in_flight()},
+        "semantic": semantic_cache.snapshot(),
+    }
+
+# -------------------------------
+# Conversation memory
+# -------------------------------
+# When /companion is called with a conversation_id the server owns the memory:
+# the prompt context is built from a token-budgeted window (MEMORY_TOKEN_BUDGET)
+# and each new summary is stored server-side. Older summaries are compacted into
+# a rolling summary in the background. Without an id the `context` parameter is
+# used as before.
+#
+# memory_mode=retrieval (or COMPANION_MEMORY_MODE in .env) swaps the window for
+# embedding retrieval: only the top-k summaries most similar to the new prompt
+# plus the last few turns go into the prompt. Every summary is stored in both
+# memories so a conversation can switch modes at any time. Worker processes can
+# share both: their writes are serialized with a file lock, so they run in a thread.
+DEFAULT_MEMORY_MODE = os.getenv("COMPANION_MEMORY_MODE", "window")
+conversation_memory = memory_from_env()
+retrieval_memory = retrieval_from_env(embedder)
+background_tasks = set()
+
+async def summarize(text):
+    return (await call_model(get_model(), text)).content
+
+# Compaction runs after the response has been sent, so a failure (e.g. an upstream
+# error while summarizing) is only counted; the summaries stay uncompacted and the
+# next turn tries again
+async def compact_memory(conversation_id):
+    try:
+        await conversation_memory.compact(conversation_id, summarize)
+    except Exception as e:
+        record_error(classify_error(e))
+
+# An empty conversation_id means none; a malformed one is the caller's mistake (400),
+# not an upstream failure
+def check_conversation_id(conversation_id):
+    if not conversation_id:
+        return None
+    try:
+        return safe_id(conversation_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def resolve_context(conversation_id, context, prompt, memory_mode=None):
+    if conversation_id is None:
+        return context
+    if (memory_mode or DEFAULT_MEMORY_MODE) == "retrieval":
+        return await asyncio.to_thread(retrieval_memory.build_context, conversation_id, prompt)
+    return conversation_memory.build_context(conversation_id)
+
+async def remember(conversation_id, context_summary):
+    if conversation_id is None:
+        return
+    await conversation_memory.append(conversation_id, context_summary)
+    await asyncio.to_thread(retrieval_memory.add, conversation_id, [context_summary])
+    if conversation_memory.needs_compaction(conversation_id):
+        task = asyncio.create_task(compact_memory(conversation_id))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+# Seed memory for a conversation created before memory moved server-side
+@router.put("/companion/memory/{conversation_id}")
+async def seed_memory(conversation_id: str, summaries: list[str] = Body(...)):
+    try:
+        seeded = await conversation_memory.seed(conversation_id, summaries)
+        if seeded:
+            await asyncio.to_thread(retrieval_memory.add, conversation_id, summaries)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"conversation_id": conversation_id, "seeded": seeded, "turns": conversation_memory.load(conversation_id)["turns"]}
+
+@router.delete("/companion/memory/{conversation_id}")
+async def delete_memory(conversation_id: str):
+    try:
+        await conversation_memory.delete(conversation_id)
+        await asyncio.to_thread(retrieval_memory.delete, conversation_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"conversation_id": conversation_id, "deleted": True}
+
+# Every streamed event is a small JSON object, {"event": ..., **data}. The streaming
+# endpoints send them as Server-Sent-Events (format=sse, the default: the event name
+# plus the data as JSON) or, with format=ndjson, as one JSON line each.
+def stream_event(event, **data):
+    return {"event": event, **data}
+
+def ndjson_line(item):
+    return orjson.dumps(item) + b"\n"
+
+async def sse_events(events):
+    async for item in events:
+        event = item.pop("event")
+        yield {"event": event, "data": orjson.dumps(item).decode()}
+
+async def ndjson_lines(items):
+    async for item in items:
+        yield ndjson_line(item)
+
+def event_response(events, format):
+    if format == "ndjson":
+        return StreamingResponse(ndjson_lines(events), media_type="application/x-ndjson")
+    return EventSourceResponse(sse_events(events))
+
+# -------------------------------
+# Background jobs
+# -------------------------------
+# /essay, /poem and /generate-image accept mode=job: the request is queued on a
+# bounded worker pool (JOB_WORKERS) and answered at once with 202 and a job id.
+# GET /jobs/{job_id}?wait=N polls (or long-polls up to N seconds) for the result,
+# which is the same body the synchronous call would have returned. Finished jobs
+# are kept for JOB_TTL seconds.
+jobs = jobs_from_env(state_store)
+
+def submit_job(kind, fn):
+    endpoint = current_endpoint()
+
+    async def run():
+        # Jobs run on worker tasks; keep the metrics labelled with the submitting endpoint
+        current_request.set(RequestTiming(endpoint))
+        return await fn()
+
+    job = jobs.submit(kind, run)
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": job.id, "status": job.status, "status_url": f"/jobs/{job.id}"},
+    )
+
+async def job_queue_full(request, exc):
+    record_error("server_busy")
+    return JSONResponse(status_code=503, content={"error": "Too many queued jobs, please retry later."},
+                        headers={"Retry-After": "5"})
+
+@router.get("/jobs/{job_id}")
+async def job_status(job_id: str, wait: float = Query(0, ge=0, le=60)):
+    job = await jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    await jobs.wait(job, wait)
+    return job.to_dict()
+
+@router.get("/jobs")
+async def job_stats():
+    return jobs.snapshot()
+
+# -------------------------------
+# Companion endpoint
+# -------------------------------
+@router.post("/companion")
+async def companion(prompt: str, context: str = "", conversation_id: str | None = None,
+                    memory_mode: str | None = Query(None, pattern="^(window|retrieval)$"),
+                    deadline: float | None = Query(None, gt=0, le=300), no_cache: bool = False):
+    conversation_id = check_conversation_id(conversation_id)
+    try:
+        with stage("prompt"):
+            context = await resolve_context(conversation_id, context, prompt, memory_mode)
+            full_prompt = build_companion_prompt(prompt, context)
+
+        scope = make_scope(MODEL_NAME, COMPANION_VERSION, context)
+        cached = await semantic_lookup("companion", scope, prompt, no_cache)
+        if cached is not None:
+            answer, context_summary = cached
+            await remember(conversation_id, context_summary)
+            return {"answer": answer, "context_summary": context_summary}
+
+        response_obj = await call_model(structured_model(CompanionReply), full_prompt, priority=INTERACTIVE, deadline=deadline)
 
         # Check for API key error
-        if "API key not valid" in output or "Please pass a valid API key" in output:
+        if is_api_key_error(message_text(response_obj)):
+            record_error("invalid_api_key")
             return {"error": "API key not valid. Please check your Gemini API key."}
 
-        # Split answer and summary
-        lines = output.splitlines()
-        answer_lines = []
-        context_summary = ""
-        for line in lines:
-            if line.strip().startswith("SUMMARY:"):
-                context_summary = line.strip().replace("SUMMARY:", "").strip()
-            else:
-                answer_lines.append(line)
-        answer = "\n".join(answer_lines).strip()
+        with stage("parse"):
+            answer, context_summary = parse_companion_reply(response_obj)
 
         if not answer or not context_summary:
+            record_error("parse_failure")
             return {"error": "API ERROR From Server"}
 
+        await semantic_store("companion", scope, prompt, (answer, context_summary))
+        await remember(conversation_id, context_summary)
         return {
             "answer": answer,
             "context_summary": context_summary
         }
-    except Exception:
+    except SchedulerBusy:
+        raise
+    except Exception as e:
+        record_error(classify_error(e))
         return {"error": "API ERROR From Server"}
-    
+
+# Streams "token" events with the answer as it is generated. A JSON reply is parsed
+# incrementally and the growing "answer" field is forwarded. A plain-text reply is
+# forwarded line by line as soon as each line ends, except the SUMMARY: line, which
+# is held back. The summary is sent as a separate "summary" event once the model
+# has finished.
+@router.post("/companion/stream")
+async def companion_stream(prompt: str, context: str = "", conversation_id: str | None = None,
+                           memory_mode: str | None = Query(None, pattern="^(window|retrieval)$"),
+                           no_cache: bool = False, format: str = Query("sse", pattern="^(sse|ndjson)$")):
+    conversation_id = check_conversation_id(conversation_id)
+    check_capacity()
+
+    async def events():
+        output = ""
+        pending = ""
+        try:
+            with stage("prompt"):
+                memory_context = await resolve_context(conversation_id, context, prompt, memory_mode)
+                full_prompt = build_companion_prompt(prompt, memory_context)
+
+            scope = make_scope(MODEL_NAME, COMPANION_VERSION, memory_context)
+            cached = await semantic_lookup("companion", scope, prompt, no_cache)
+            if cached is not None:
+                answer, context_summary = cached
+                await remember(conversation_id, context_summary)
+                yield stream_event("token", text=answer)
+                yield stream_event("summary", answer=answer, context_summary=context_summary)
+                return
+
+            structured = JsonFieldStream("answer") if STRUCTURED_OUTPUT else None
+            async for text in stream_model(get_model(), full_prompt, priority=INTERACTIVE):
+                output += text
+                if structured is not None:
+                    mode = structured.feed(text)
+                    if mode == "json":
+                        delta = structured.delta()
+                        if delta:
+                            yield stream_event("token", text=delta)
+                    if mode != "text":
+                        continue
+                    # Not JSON after all: stream everything so far as plain text
+                    structured, text = None, output
+                pending += text
+                # Keep the unfinished last line back until we know it isn't the summary
+                *complete, pending = pending.split("\n")
+                lines = [line for line in complete if not line.strip().startswith("SUMMARY:")]
+                if lines:
+                    yield stream_event("token", text="\n".join(lines) + "\n")
+
+            if pending and not pending.strip().startswith("SUMMARY:"):
+                yield stream_event("token", text=pending)
+
+            if is_api_key_error(output):
+                record_error("invalid_api_key")
+                yield stream_event("error", error="API key not valid. Please check your Gemini API key.")
+                return
+
+            with stage("parse"):
+                from langchain_core.messages import AIMessage
+                answer, context_summary = parse_companion_reply(AIMessage(content=output))
+            if not answer or not context_summary:
+                record_error("parse_failure")
+                yield stream_event("error", error="API ERROR From Server")
+                return
+            # Whatever the incremental parse hadn't forwarded yet
+            if structured is not None and answer.startswith(structured.emitted.lstrip()):
+                rest = answer[len(structured.emitted.lstrip()):]
+                if rest:
+                    yield stream_event("token", text=rest)
+
+            await semantic_store("companion", scope, prompt, (answer, context_summary))
+            await remember(conversation_id, context_summary)
+            yield stream_event("summary", answer=answer, context_summary=context_summary)
+        except Exception as e:
+            record_error(classify_error(e))
+            yield stream_event("error", error="API ERROR From Server")
+
+    return event_response(events(), format)
+
 # -------------------------------
 # Essay endpoint
 # -------------------------------
-@app.get("/essay")
-async def essay(topic: str, length: int = 100):
+@router.get("/essay")
+async def essay(topic: str, length: int = 100, no_cache: bool = False,
+                deadline: float | None = Query(None, gt=0, le=300),
+                mode: str = Query("sync", pattern="^(sync|job)$")):
+    if mode == "job":
+        return submit_job("essay", lambda: essay(topic, length, no_cache, deadline, "sync"))
     try:
-        prompt = ChatPromptTemplate.from_template(
-    "Write an engaging and informative essay about {topic} in approximately {length} words. "
-    "Use clear, simple language so that readers of all ages can enjoy and understand it. "
-    "Organize the essay with a brief introduction, a well-structured body, and a thoughtful conclusion. "
-    "Make the content interesting and easy to read."
-)
-        # When you do chain = prompt | model, you create a LangChain "Runnable" chain.
-        chain = prompt | model
+        key = text_cache_key("essay", ESSAY_TEMPLATE, topic, length)
+        cached = cache_lookup(key, no_cache)
+        if cached is not None:
+            return {"topic": topic, "length": length, "essay": cached}
 
-        # Both the Gemini model (ChatGoogleGenerativeAI) and the chain object support the .invoke() method.
-        # This method is used to send input to the model (or chain) and get the output.
-        response = chain.invoke({"topic": topic, "length": length})
+        # chain is prompt | model, a LangChain "Runnable" chain (built once, see text_chain)
+        chain = text_chain(ESSAY_TEMPLATE)
 
-        return {"topic": topic, "length": length, "essay": response.content}
-    except Exception:
+        # Both the Gemini model (ChatGoogleGenerativeAI) and the chain object support the .ainvoke() method.
+        # It sends input to the model (or chain) and awaits the output without blocking the event loop.
+        text = await generate_text_once(key, chain, topic, length, deadline)
+
+        return {"topic": topic, "length": length, "essay": text}
+    except SchedulerBusy:
+        raise
+    except Exception as e:
+        record_error(classify_error(e))
         return {"topic": topic, "length": length, "essay": "API ERROR From Server"}
 
 # -------------------------------
 # Poem endpoint
 # -------------------------------
-@app.get("/poem")
-async def poem(topic: str, length: int = 30):
+@router.get("/poem")
+async def poem(topic: str, length: int = 30, no_cache: bool = False,
+               deadline: float | None = Query(None, gt=0, le=300),
+               mode: str = Query("sync", pattern="^(sync|job)$")):
+    if mode == "job":
+        return submit_job("poem", lambda: poem(topic, length, no_cache, deadline, "sync"))
     try:
-        prompt = ChatPromptTemplate.from_template(
-    "Write a creative and heartwarming poem about {topic} in approximately {length} words. "
-    "Use simple, relatable language and imagery that resonates with Indian culture and everyday life. "
-    "Ensure the poem has a pleasant rhyme scheme and is enjoyable to read for all ages. "
-    "Make the poem emotionally engaging and easy to understand."
-)
-        chain = prompt | model
-        response = chain.invoke({"topic": topic, "length": length})
-        return {"topic": topic, "length": length, "poem": response.content}
-    except Exception:
+        key = text_cache_key("poem", POEM_TEMPLATE, topic, length)
+        cached = cache_lookup(key, no_cache)
+        if cached is not None:
+            return {"topic": topic, "length": length, "poem": cached}
+
+        chain = text_chain(POEM_TEMPLATE)
+        text = await generate_text_once(key, chain, topic, length, deadline)
+        return {"topic": topic, "length": length, "poem": text}
+    except SchedulerBusy:
+        raise
+    except Exception as e:
+        record_error(classify_error(e))
         return {"topic": topic, "length": length, "poem": "API ERROR From Server"}
-    
+
+# -------------------------------
+# Essay / Poem streaming endpoints
+# -------------------------------
+# Streams "token" events as the text is generated, then one "done" event with the
+# full text (same shape as the non-streaming response) or an "error" event.
+# A cache hit is sent as a single token event.
+def stream_text_events(template, field, topic, length, no_cache, format):
+    check_capacity()
+
+    async def events():
+        text = ""
+        try:
+            key = text_cache_key(field, template, topic, length)
+            cached = cache_lookup(key, no_cache)
+            if cached is not None:
+                yield stream_event("token", text=cached)
+                yield stream_event("done", topic=topic, length=length, **{field: cached})
+                return
+
+            chain = text_chain(template)
+            async for chunk in stream_model(chain, {"topic": topic, "length": length}):
+                text += chunk
+                yield stream_event("token", text=chunk)
+            response_cache.set(key, text)
+            yield stream_event("done", topic=topic, length=length, **{field: text})
+        except Exception as e:
+            record_error(classify_error(e))
+            yield stream_event("error", error="API ERROR From Server")
+
+    return event_response(events(), format)
+
+@router.get("/essay/stream")
+async def essay_stream(topic: str, length: int = 100, no_cache: bool = False,
+                       format: str = Query("sse", pattern="^(sse|ndjson)$")):
+    return stream_text_events(ESSAY_TEMPLATE, "essay", topic, length, no_cache, format)
+
+@router.get("/poem/stream")
+async def poem_stream(topic: str, length: int = 30, no_cache: bool = False,
+                      format: str = Query("sse", pattern="^(sse|ndjson)$")):
+    return stream_text_events(POEM_TEMPLATE, "poem", topic, length, no_cache, format)
+
+# -------------------------------
+# Essay / Poem batch endpoints
+# -------------------------------
+# Many (topic, length) items in one request. Cached items are answered directly;
+# the rest go through LangChain's abatch on the prompt | model chain, with at most
+# BATCH_CONCURRENCY items in flight. Results come back in request order with a
+# per-item "error" instead of failing the whole batch. With stream=true the
+# response is NDJSON and each item is written as soon as it finishes.
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+
+class BatchItem(BaseModel):
+    topic: str
+    length: int | None = None
+
+class BatchRequest(BaseModel):
+    items: list[BatchItem] = Field(..., min_length=1, max_length=BATCH_MAX_ITEMS)
+    no_cache: bool = False
+
+def batch_result(index, field, topic, length, text=None, error=None):
+    result = {"index": index, "topic": topic, "length": length}
+    if error is None:
+        result[field] = text
+    else:
+        result["error"] = error
+    return result
+
+# Splits a batch into items already in the cache and items that need the model
+class TextBatch:
+    def __init__(self, template, field, default_length, request):
+        self.field = field
+        self.items = [(item.topic, item.length or default_length) for item in request.items]
+        self.keys = [text_cache_key(field, template, topic, length) for topic, length in self.items]
+        self.chain = batch_chain(template)
+        self.config = {"max_concurrency": BATCH_CONCURRENCY}
+        self.cached = {}
+        for index, key in enumerate(self.keys):
+            text = cache_lookup(key, request.no_cache)
+            if text is not None:
+                self.cached[index] = batch_result(index, field, *self.items[index], text=text)
+        self.pending = [index for index in range(len(self.items)) if index not in self.cached]
+        self.inputs = [{"topic": self.items[i][0], "length": self.items[i][1]} for i in self.pending]
+
+    def finish(self, index, response):
+        if isinstance(response, Exception):
+            record_error(classify_error(response))
+            return batch_result(index, self.field, *self.items[index], error="API ERROR From Server")
+        response_cache.set(self.keys[index], response.content)
+        return batch_result(index, self.field, *self.items[index], text=response.content)
+
+    async def results(self):
+        responses = await self.chain.abatch(self.inputs, config=self.config, return_exceptions=True) if self.inputs else []
+        results = dict(self.cached)
+        for index, response in zip(self.pending, responses):
+            results[index] = self.finish(index, response)
+        return {"results": [results[index] for index in range(len(self.items))]}
+
+    async def ndjson(self):
+        for result in self.cached.values():
+            yield ndjson_line(result)
+        if self.inputs:
+            async for position, response in self.chain.abatch_as_completed(self.inputs, config=self.config, return_exceptions=True):
+                yield ndjson_line(self.finish(self.pending[position], response))
+
+@router.post("/essay/batch")
+async def essay_batch(request: BatchRequest, stream: bool = False):
+    batch = TextBatch(ESSAY_TEMPLATE, "essay", 100, request)
+    if stream:
+        return StreamingResponse(batch.ndjson(), media_type="application/x-ndjson")
+    return await batch.results()
+
+@router.post("/poem/batch")
+async def poem_batch(request: BatchRequest, stream: bool = False):
+    batch = TextBatch(POEM_TEMPLATE, "poem", 30, request)
+    if stream:
+        return StreamingResponse(batch.ndjson(), media_type="application/x-ndjson")
+    return await batch.results()
+
 # -------------------------------
 # IMAGE GENERATION ENDPOINT
 # -------------------------------
-@app.get("/generate-image")
-async def generate_image(prompt: str, num_images: int = 2):
+def pollinations_images(prompts):
+    images = []
+    for refined_prompt in prompts:
+        image_url = f"https://image.pollinations.ai/prompt/{refined_prompt}?nologo=true"
+        images.append({"prompt": refined_prompt, "image_url": image_url})
+    return images
+
+@router.get("/generate-image")
+async def generate_image(prompt: str, num_images: int = 2, deadline: float | None = Query(None, gt=0, le=300),
+                         mode: str = Query("sync", pattern="^(sync|job)$"), no_cache: bool = False):
+    if mode == "job":
+        return submit_job("generate-image", lambda: generate_image(prompt, num_images, deadline, "sync", no_cache))
     try:
-        gemini_request = (
-            f"Generate {num_images} distinct image generation prompts for Pollinations AI based on: '{prompt}'. "
-            "Return them as a numbered list."
+        # A near-identical earlier prompt reuses its refined prompts (no Gemini call)
+        scope = make_scope(MODEL_NAME, num_images)
+        prompts = await semantic_lookup("generate-image", scope, prompt, no_cache)
+        if prompts is not None:
+            return {"original_prompt": prompt, "images": pollinations_images(prompts)}
+
+        gemini_response = await call_model(
+            structured_model(ImagePrompts), build_image_request(prompt, num_images), priority=INTERACTIVE, deadline=deadline
         )
-        gemini_response = model.invoke(gemini_request).content
 
         # Check for API key error in Gemini response
-        if "API key not valid" in gemini_response or "Please pass a valid API key" in gemini_response:
+        if is_api_key_error(message_text(gemini_response)):
+            record_error("invalid_api_key")
             return {"error": "API key not valid. Please check your Gemini API key."}
 
-        # Create the list of the refined prompts we got from the gemini
-        prompts = []
-        for line in gemini_response.splitlines():
-            line = line.strip()
-            if line and (line[0].isdigit() or line.startswith("-")):
-                prompt_text = line.split('.', 1)[-1].strip() if '.' in line else line.lstrip('-').strip()
-                if prompt_text:
-                    prompts.append(prompt_text)
-            elif line:
-                prompts.append(line)
-        prompts = prompts[:num_images]
+        # The refined prompts we got from the gemini
+        with stage("parse"):
+            prompts = parse_image_prompts(gemini_response, num_images)
 
         if not prompts or any([p.lower().startswith("error") for p in prompts]):
+            record_error("parse_failure")
             return {"error": "API ERROR From Server"}
 
-        images = []
-        for refined_prompt in prompts:
-            image_url = f"https://image.pollinations.ai/prompt/{refined_prompt}?nologo=true"
-            images.append({"prompt": refined_prompt, "image_url": image_url})
-
-        return {"original_prompt": prompt, "images": images}
-    except Exception:
+        await semantic_store("generate-image", scope, prompt, prompts)
+        return {"original_prompt": prompt, "images": pollinations_images(prompts)}
+    except SchedulerBusy:
+        raise
+    except Exception as e:
+        record_error(classify_error(e))
         return {"error": "API ERROR From Server"}
 
 
+# -------------------------------
+# Readiness and warm-up
+# -------------------------------
+# With WARMUP=1 (default) the model client, chains, structured runnables and the
+# embedder are built while the server starts, before it accepts connections, so
+# the first requests don't pay for it. WARMUP_CALL=1 also makes one small upstream
+# call. GET /ready answers 503 until warm-up is done, for load balancer health checks.
+WARMUP = os.getenv("WARMUP", "1") == "1"
+WARMUP_CALL = os.getenv("WARMUP_CALL", "0") == "1"
+
+async def warm_up():
+    with startup.phase("warmup"):
+        get_model()
+        for template in (ESSAY_TEMPLATE, POEM_TEMPLATE):
+            text_chain(template)
+            batch_chain(template)
+        structured_model(CompanionReply)
+        structured_model(ImagePrompts)
+        semantic_cache.embedder.embed(["warm up"])
+        import faiss  # Not loaded at import time (see retrieval.py); load it before the first request
+        if WARMUP_CALL:
+            await call_model(get_model(), "Reply with the single word OK.", deadline=30)
+
+@router.get("/ready")
+async def ready():
+    if not startup.ready:
+        return JSONResponse(status_code=503, content={"ready": False, "startup": startup.snapshot()})
+    return {"ready": True, "startup": startup.snapshot()}
+
+startup.mark("init")
+
+# -------------------------------
+# App factory
+# -------------------------------
+# `uvicorn app:app` uses the module-level app below; `uvicorn --factory app:create_app`
+# builds a fresh one. Pass warmup=False to skip the warm-up (e.g. in tests).
+# With CAPTURE=1 requests are recorded to CAPTURE_FILE (a CAPTURE_SAMPLE share
+# of them) for replay with bench/replay.py; see capture.py. Responses are encoded
+# with orjson and, above COMPRESS_MIN_BYTES, compressed with zstd or gzip (see
+# compression.py; COMPRESSION=0 turns it off).
+def create_app(warmup=None):
+    warmup = WARMUP if warmup is None else warmup
+    capture = capture_from_env()
+    compress_min_bytes = compression_from_env()
+
+    @asynccontextmanager
+    async def lifespan(app):
+        if state_store is not None:
+            state_store.open()
+        if warmup:
+            try:
+                await warm_up()
+            except Exception as e:
+                # A failed warm-up (e.g. no API key yet) shouldn't keep the server down
+                record_error(classify_error(e))
+        startup.ready = True
+        logger.info(startup.summary())
+        yield
+
+    app = FastAPI(
+        title="Langchain Server",
+        version="1.0",
+        description="A simple API Server with Gemini",
+        lifespan=lifespan,
+        default_response_class=ORJSONResponse,
+    )
+    if capture is not None:
+        # Added first so it runs inside MetricsMiddleware and sees the request's timings
+        app.add_middleware(CaptureMiddleware, writer=capture, sample=float(os.getenv("CAPTURE_SAMPLE", "1")))
+    app.add_middleware(MetricsMiddleware)
+    if compress_min_bytes is not None:
+        # Outermost, so the metrics and the capture see the uncompressed body
+        app.add_middleware(CompressionMiddleware, min_size=compress_min_bytes)
+    app.add_exception_handler(SchedulerBusy, scheduler_busy)
+    app.add_exception_handler(JobQueueFull, job_queue_full)
+    app.include_router(router)
+    return app
+
+app = create_app()
+
 # -------------------------------
 # Run server
 # -------------------------------
 if __name__ == "__main__":
+    # Single process; see serve.py for several workers and a configurable bind address
     uvicorn.run(app, host="localhost", port=8000)
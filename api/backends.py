@@ -0,0 +1,158 @@
+# Model backends, selected with MODEL_BACKEND in .env:
+#   gemini (default) - Google Gemini through langchain_google_genai
+#   fake             - local FakeChatModel for load tests, no API key or quota needed
+import asyncio
+import json
+import os
+import random
+import re
+import time
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+
+WORDS = (
+    "the monsoon brings fresh green fields rivers songs of birds and a cup of warm chai "
+    "children play in the rain farmers smile and villages come alive with colour and joy"
+).split()
+
+
+# Builds a reply shaped like what each endpoint expects from Gemini
+def fake_reply(prompt, rng):
+    match = re.search(r"approximately (\d+) words", prompt)
+    length = int(match.group(1)) if match else 60
+    body = " ".join(rng.choice(WORDS) for _ in range(length))
+
+    match = re.search(r"Generate (\d+) distinct image generation prompts", prompt)
+    if match:
+        prompts = [" ".join(rng.choice(WORDS) for _ in range(8)) for _ in range(int(match.group(1)))]
+        if '{"prompts"' in prompt:
+            return json.dumps({"prompts": prompts})
+        return "\n".join(f"{i}. {p}" for i, p in enumerate(prompts, 1))
+    if '{"answer"' in prompt:
+        return json.dumps({"answer": body, "summary": " ".join(rng.choice(WORDS) for _ in range(25))})
+    if "SUMMARY:" in prompt:
+        summary = " ".join(rng.choice(WORDS) for _ in range(25))
+        return f"{body}\nSUMMARY: {summary}"
+    return body
+
+
+def prompt_text(messages):
+    return "\n".join(str(m.content) for m in messages)
+
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+# Offline stand-in for Gemini with a configurable latency profile. Time to first
+# token is drawn from a log-normal distribution around latency_ms (latency_sigma=0
+# makes it fixed), the reply is then produced at tokens_per_sec, and failure_rate
+# of the calls raise.
+class FakeChatModel(BaseChatModel):
+    latency_ms: float = 300.0
+    latency_sigma: float = 0.5
+    tokens_per_sec: float = 200.0
+    failure_rate: float = 0.0
+    seed: int | None = None
+    _rng: random.Random = PrivateAttr()
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._rng = random.Random(self.seed)
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def _first_token_delay(self):
+        delay = self.latency_ms / 1000
+        if self.latency_sigma:
+            delay *= self._rng.lognormvariate(0, self.latency_sigma)
+        return delay
+
+    def _maybe_fail(self):
+        if self._rng.random() < self.failure_rate:
+            raise RuntimeError("Fake upstream failure")
+
+    def _message(self, prompt, reply):
+        usage = {
+            "input_tokens": estimate_tokens(prompt),
+            "output_tokens": estimate_tokens(reply),
+            "total_tokens": estimate_tokens(prompt) + estimate_tokens(reply),
+        }
+        return AIMessage(content=reply, usage_metadata=usage)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = prompt_text(messages)
+        reply = fake_reply(prompt, self._rng)
+        time.sleep(self._first_token_delay() + estimate_tokens(reply) / self.tokens_per_sec)
+        self._maybe_fail()
+        return ChatResult(generations=[ChatGeneration(message=self._message(prompt, reply))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = prompt_text(messages)
+        reply = fake_reply(prompt, self._rng)
+        await asyncio.sleep(self._first_token_delay() + estimate_tokens(reply) / self.tokens_per_sec)
+        self._maybe_fail()
+        return ChatResult(generations=[ChatGeneration(message=self._message(prompt, reply))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = prompt_text(messages)
+        reply = fake_reply(prompt, self._rng)
+        await asyncio.sleep(self._first_token_delay())
+        self._maybe_fail()
+        # One chunk per word (keeping the separators) at the configured token rate
+        for piece in re.findall(r"\S+\s*|\s+", reply):
+            await asyncio.sleep(estimate_tokens(piece) / self.tokens_per_sec)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        # Token usage arrives on a final empty chunk, as with the real streaming APIs
+        usage = self._message(prompt, reply).usage_metadata
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
+
+
+def fake_model_from_env():
+    seed = os.getenv("FAKE_SEED")
+    return FakeChatModel(
+        latency_ms=float(os.getenv("FAKE_LATENCY_MS", "300")),
+        latency_sigma=float(os.getenv("FAKE_LATENCY_SIGMA", "0.5")),
+        tokens_per_sec=float(os.getenv("FAKE_TOKENS_PER_SEC", "200")),
+        failure_rate=float(os.getenv("FAKE_FAILURE_RATE", "0")),
+        seed=int(seed) if seed else None,
+    )
+
+
+# Retries of upstream calls belong to ResilientCaller (retry budget, hedging and
+# deadlines, see resilience.py), so the Gemini client makes one attempt per call.
+# ChatGoogleGenerativeAI retries in two places of its own: a tenacity wrapper
+# around every request (max_retries in newer releases, a fixed 2 attempts in
+# 2.0.x, hence the pass-through decorator) and the gRPC client's default retry
+# on 503, which retry=None switches off per call.
+def single_attempt_gemini(model_name):
+    from langchain_google_genai import ChatGoogleGenerativeAI, chat_models  # Gemini model integration for LangChain
+
+    chat_models._create_retry_decorator = lambda *args, **kwargs: (lambda fn: fn)
+
+    class SingleAttemptGemini(ChatGoogleGenerativeAI):
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            kwargs.setdefault("retry", None)
+            return await super()._agenerate(messages, stop, run_manager, **kwargs)
+
+        async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+            kwargs.setdefault("retry", None)
+            async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+                yield chunk
+
+    return SingleAttemptGemini(model=model_name, max_retries=0)
+
+
+def create_model(model_name):
+    backend = os.getenv("MODEL_BACKEND", "gemini")
+    if backend == "fake":
+        return fake_model_from_env()
+    if backend == "gemini":
+        return single_attempt_gemini(model_name)
+    raise ValueError(f"Unknown MODEL_BACKEND: {backend!r}")
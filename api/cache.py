@@ -0,0 +1,216 @@
+# Response cache for the pure generation endpoints (/essay, /poem).
+# Two tiers: an in-memory LRU with a TTL, and an optional SQLite file that
+# survives restarts and can be shared by several uvicorn workers.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Lower-case and collapse whitespace so "Chai ", "chai" and "CHAI" share an entry
+def normalize_topic(topic):
+    return " ".join(topic.split()).casefold()
+
+
+# Short, stable fingerprint of a prompt template; changing the wording changes the key
+def template_version(template):
+    return hashlib.sha1(template.encode("utf-8")).hexdigest()[:12]
+
+
+def make_key(endpoint, topic, length, model_name, version):
+    return json.dumps([endpoint, normalize_topic(topic), int(length), model_name, version], ensure_ascii=False)
+
+
+# -------------------------------
+# In-memory tier
+# -------------------------------
+class MemoryCache:
+    def __init__(self, max_entries=1024, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.time() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# -------------------------------
+# On-disk tier
+# -------------------------------
+# Expired rows are never returned; they are swept out every `sweep_every` writes
+# or `sweep_interval` seconds, whichever comes first, not on every write.
+class SqliteCache:
+    def __init__(self, path, ttl=3600, sweep_every=256, sweep_interval=60.0):
+        self.path = path
+        self.ttl = ttl
+        self.sweep_every = sweep_every
+        self.sweep_interval = sweep_interval
+        self._writes = 0
+        self._swept_at = time.monotonic()
+        self._sweep_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # One connection per thread; WAL lets several worker processes read while one writes
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at < time.time():
+            with self._connect() as conn:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (ttl or self.ttl)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at),
+            )
+        if self._sweep_due():
+            self.sweep()
+
+    def _sweep_due(self):
+        with self._sweep_lock:
+            self._writes += 1
+            if self._writes < self.sweep_every and time.monotonic() - self._swept_at < self.sweep_interval:
+                return False
+            self._writes = 0
+            self._swept_at = time.monotonic()
+            return True
+
+    def sweep(self):
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),)).rowcount
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache")
+
+
+# -------------------------------
+# Shared-store tier
+# -------------------------------
+# Used instead of SqliteCache with STATE_BACKEND=redis, so all workers on all
+# hosts share the second tier (see shared_state.py).
+class StoreCache:
+    def __init__(self, store, ttl=3600):
+        self.store = store
+        self.ttl = ttl
+
+    def _key(self, key):
+        return "cache:" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        return self.store.get(self._key(key))
+
+    def set(self, key, value, ttl=None):
+        self.store.set(self._key(key), value, ttl=ttl or self.ttl)
+
+    # Entries expire on their own; there is no cheap way to list them in the store
+    def clear(self):
+        pass
+
+
+# -------------------------------
+# Tiered cache
+# -------------------------------
+class ResponseCache:
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+        self.stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0}
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.stats["hits"] += 1
+            self.stats["memory_hits"] += 1
+            return value
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                # Promote to the memory tier so the next hit is cheaper
+                self.memory.set(key, value)
+                self.stats["hits"] += 1
+                self.stats["disk_hits"] += 1
+                return value
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def snapshot(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "disk_enabled": self.disk is not None,
+        }
+
+
+# Build the cache from .env settings (CACHE_TTL, CACHE_MAX_ENTRIES, CACHE_DB). With
+# STATE_BACKEND=redis the second tier is the shared store instead of CACHE_DB.
+def cache_from_env(store=None):
+    ttl = int(os.getenv("CACHE_TTL", "3600"))
+    memory = MemoryCache(max_entries=int(os.getenv("CACHE_MAX_ENTRIES", "1024")), ttl=ttl)
+    db_path = os.getenv("CACHE_DB", "")
+    if store is not None and os.getenv("STATE_BACKEND", "sqlite") == "redis":
+        disk = StoreCache(store, ttl=ttl)
+    else:
+        disk = SqliteCache(db_path, ttl=ttl) if db_path else None
+    return ResponseCache(memory, disk)
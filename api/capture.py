@@ -0,0 +1,150 @@
+# Traffic capture for record-and-replay (see bench/replay.py).
+# With CAPTURE=1 every request is appended to CAPTURE_FILE as one JSON line:
+# arrival time, method, path, route, query string, request body, status, duration,
+# per-stage timings and cache outcomes (from metrics.RequestTiming), and the size
+# and sha256 of the response body. Records are buffered and written in batches
+# (CAPTURE_BATCH lines or every CAPTURE_FLUSH seconds, whichever comes first) from
+# a thread, so a request only pays for building its record.
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+
+from metrics import current_request
+
+
+# Scrapes and health checks are not traffic worth replaying
+SKIP_PATHS = {"/metrics", "/ready"}
+
+
+class CaptureWriter:
+    def __init__(self, path, batch_size=100, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self._buffer = []
+        self._wake = None
+        self._task = None
+
+    def add(self, record):
+        self._buffer.append(json.dumps(record, ensure_ascii=False))
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        lines, self._buffer = self._buffer, []
+        if lines:
+            await asyncio.to_thread(self._write, lines)
+
+    # One O_APPEND write per batch, so batches from several worker processes don't interleave
+    def _write(self, lines):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, ("\n".join(lines) + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
+        self.written += len(lines)
+
+
+# Pure ASGI, like MetricsMiddleware, and installed inside it so the request's
+# RequestTiming is available. Bodies over max_body bytes are recorded as truncated.
+class CaptureMiddleware:
+    def __init__(self, app, writer, sample=1.0, max_body=65536):
+        self.app = app
+        self.writer = writer
+        self.sample = sample
+        self.max_body = max_body
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.app(scope, self._flush_on_shutdown(receive), send)
+        if scope["type"] != "http" or scope["path"] in SKIP_PATHS or random.random() >= self.sample:
+            return await self.app(scope, receive, send)
+
+        arrived = time.time()
+        start = time.perf_counter()
+        body = bytearray()
+        truncated = False
+        digest = hashlib.sha256()
+        size = 0
+        status = 500
+
+        async def receive_wrapper():
+            nonlocal truncated
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                if len(body) + len(chunk) <= self.max_body:
+                    body.extend(chunk)
+                else:
+                    truncated = True
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                digest.update(chunk)
+                size += len(chunk)
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            timing = current_request.get()
+            self.writer.add({
+                "ts": round(arrived, 6),
+                "method": scope["method"],
+                "path": scope["path"],
+                "endpoint": timing.endpoint if timing else None,
+                "query": scope.get("query_string", b"").decode("latin-1"),
+                "body": None if truncated or not body else body.decode("utf-8", "replace"),
+                "body_truncated": truncated,
+                "status": status,
+                "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                "stages_ms": {k: round(v * 1000, 3) for k, v in timing.stages.items()} if timing else {},
+                "cache": dict(timing.cache) if timing else {},
+                "response_bytes": size,
+                "response_sha256": digest.hexdigest(),
+            })
+
+    # Write out whatever is still buffered when the server shuts down
+    def _flush_on_shutdown(self, receive):
+        async def wrapper():
+            message = await receive()
+            if message["type"] == "lifespan.shutdown":
+                await self.writer.flush()
+            return message
+        return wrapper
+
+
+# Build the capture writer from .env settings (CAPTURE, CAPTURE_FILE, CAPTURE_BATCH,
+# CAPTURE_FLUSH); None when capture is off
+def capture_from_env():
+    if os.getenv("CAPTURE", "0") != "1":
+        return None
+    return CaptureWriter(
+        os.getenv("CAPTURE_FILE", "../storage/capture.jsonl"),
+        batch_size=int(os.getenv("CAPTURE_BATCH", "100")),
+        flush_interval=float(os.getenv("CAPTURE_FLUSH", "1")),
+    )
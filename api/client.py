@@ -1,7 +1,9 @@
-import requests
 import streamlit as st
 import os
-import glob
+
+from api_client import ApiClient, ApiError, ApiStatusError
+from conversation_store import ConversationStore
+from image_store import ImageStore
 
 # ================================
 # Storage Functions
@@ -12,147 +14,213 @@ def save_to_file(filename, content):
     with open(filename, "w", encoding="utf-8") as f:
         f.write(content)
 
-# This is use to load the data from the file
+# (mtime, size) of a file, or None if it doesn't exist
+def file_version(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+# Contents cached across reruns and sessions until the file changes
+@st.cache_data(max_entries=32, show_spinner=False)
+def read_file_cached(filename, version):
+    with open(filename, "r", encoding="utf-8") as f:
+        return f.read()
+
+# This is use to load the data from the file; a rerun only costs a stat() unless the file changed
 def load_from_file(filename):
-    if os.path.exists(filename):
-        with open(filename, "r", encoding="utf-8") as f:
-            return f.read()
-    return ""
+    version = file_version(filename)
+    if version is None:
+        return ""
+    return read_file_cached(filename, version)
 
 IMAGES_FILE = "../storage/images.txt"
 IMAGES_DIR = "../storage/images"
 
 
-def save_images_info(prompt, images):
-    # Save prompt and local image paths to images.txt
+IMAGES_MAX_MB = 200
+
+# One pooled, content-addressed image store per Streamlit server process
+@st.cache_resource
+def get_image_store():
+    return ImageStore(IMAGES_DIR, max_bytes=IMAGES_MAX_MB * 1024 * 1024)
+
+# Save the prompt and the local image paths to images.txt (the last result shown in the tab)
+def write_images_info(prompt, image_paths):
     with open(IMAGES_FILE, "w", encoding="utf-8") as f:
         f.write(f"{prompt}\n")
-        for idx in range(1, len(images)+1):
-            local_path = os.path.join(IMAGES_DIR, f"{idx}.jpg")
+        for idx, local_path in enumerate(image_paths, 1):
             f.write(f"{idx}: {local_path}\n")
 
-    # Save each image file to storage/images/1.jpg, 2.jpg, 3.jpg
-    if not os.path.exists(IMAGES_DIR):
-        os.makedirs(IMAGES_DIR)
-
-    # This loops over the images list, giving you both the index (idx) and the image dictionary (img).
-    # The 1 means indexing starts at 1 (not 0), so the first image will be saved as 1.jpg, the second as 2.jpg, etc.
-    for idx, img in enumerate(images, 1):
-        img_url = img['image_url']
-        img_path = os.path.join(IMAGES_DIR, f"{idx}.jpg")
-        try:
-            response = requests.get(img_url)
-            if response.status_code == 200:
-                with open(img_path, "wb") as img_file:
-                    img_file.write(response.content)
-        except Exception as e:
-            print(f"Error downloading image {idx}: {e}")
+# Download all images concurrently into the store and record them; returns the local paths
+def save_images_info(prompt, images, num_images):
+    image_paths = [p for p in get_image_store().fetch_all(prompt, images, num_images) if p]
+    write_images_info(prompt, image_paths)
+    return image_paths
 
 def load_images_info():
-    if os.path.exists(IMAGES_FILE):
-        with open(IMAGES_FILE, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-            if lines:
-                prompt = lines[0].strip()
-                image_paths = [line.split(": ", 1)[1].strip() for line in lines[1:] if ": " in line]
-                return prompt, image_paths
+    lines = load_from_file(IMAGES_FILE).splitlines()
+    if lines:
+        prompt = lines[0].strip()
+        image_paths = [line.split(": ", 1)[1].strip() for line in lines[1:] if ": " in line]
+        return prompt, image_paths
     return "", []
 
 
 
 
 CONV_DIR = "../storage/conversations"
+CONV_DB = "../storage/conversations.db"
 
-# This function gets the next available conversation ID 
-def get_next_conversation_id():
-    if not os.path.exists(CONV_DIR):
-        os.makedirs(CONV_DIR)
-    files = glob.glob(os.path.join(CONV_DIR, "*.txt"))
-    ids = [int(os.path.splitext(os.path.basename(f))[0]) for f in files if os.path.basename(f).split('.')[0].isdigit()]
-    return max(ids, default=0) + 1
-
-# This function saves the conversation exchanges to a file
-def save_conversation(conv_id, exchanges):
-    if not os.path.exists(CONV_DIR):
-        os.makedirs(CONV_DIR)
-    with open(os.path.join(CONV_DIR, f"{conv_id}.txt"), "w", encoding="utf-8") as f:
-        for ex in exchanges:
-            f.write(f"PROMPT: {ex.get('prompt', '')}\n")
-            f.write(f"ANSWER: {ex.get('answer', '')}\n")
-            f.write(f"CONTEXT: {ex.get('context', '')}\n\n")  # <-- fix here
-
-# This function loads all the conversation we did when we select the particular chat
-def load_conversation(conv_id):
-    path = os.path.join(CONV_DIR, f"{conv_id}.txt")
-    exchanges = []
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            block = {}
-            for line in f:
-                if line.startswith("PROMPT:"):
-                    block['prompt'] = line[len("PROMPT:"):].strip()
-                elif line.startswith("ANSWER:"):
-                    block['answer'] = line[len("ANSWER:"):].strip()
-                elif line.startswith("CONTEXT:"):
-                    block['context'] = line[len("CONTEXT:"):].strip()
-                elif line.strip() == "":
-                    if block:
-                        exchanges.append(block)
-                        block = {}
-            if block:
-                exchanges.append(block)
-    return exchanges
+# One SQLite-backed store per Streamlit server process. Legacy <id>.txt
+# conversations are imported the first time it is opened.
+@st.cache_resource
+def get_conversation_store():
+    store = ConversationStore(CONV_DB)
+    store.migrate_text_dir(CONV_DIR)
+    return store
+
+# This function allocates the next conversation ID (atomically, in the store)
+def new_conversation():
+    return get_conversation_store().create()
+
+# This function appends a single exchange to the conversation
+def save_exchange(conv_id, exchange):
+    get_conversation_store().append(conv_id, exchange)
+
+# This function loads the conversation we did when we select the particular chat;
+# `offset`/`limit` load one page of a long history
+def load_conversation(conv_id, offset=0, limit=-1):
+    return get_conversation_store().load(conv_id, offset, limit)
+
+def conversation_turns(conv_id):
+    return get_conversation_store().turns(conv_id)
 
 # Delete the conversation 
 def delete_conversation(conv_id):
-    path = os.path.join(CONV_DIR, f"{conv_id}.txt")
-    if os.path.exists(path):
-        os.remove(path)
+    get_conversation_store().delete(conv_id)
+
+# Ids, titles and turn counts of every conversation, read from the index
+def list_conversations():
+    return get_conversation_store().list()
 
 # ================================
 # API Call Functions
 # ================================
-BASE_URL = "http://localhost:8000"
+BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000")
+
+# One pooled keep-alive HTTP client per Streamlit server process, shared by all sessions
+@st.cache_resource(show_spinner=False)
+def get_api_client():
+    return ApiClient(BASE_URL)
 
 # def get_gemini_chat(user_input):
 #     response = requests.post(f"{BASE_URL}/gemini/invoke", json={'input': user_input})
 #     return response.json()['output']['content']
 
-def get_gemini_companion_api(user_input, context):
+# The server keeps the conversation memory, so only the new prompt and the conversation id are sent
+def get_gemini_companion_api(user_input, conv_id):
     try:
-        response = requests.post(
-            f"{BASE_URL}/companion",
-            params={"prompt": user_input, "context": context}
-        )
-        data = response.json()
-        if "error" in data:
-            return None, None, f"Error: {data['error']}"
+        data = get_api_client().companion(user_input, conversation_id=conv_id)
         return data["answer"], data["context_summary"], None
-    except Exception as e:
+    except ApiError as e:
         return None, None, f"Error: {str(e)}"
 
+# Hand the stored summaries of an existing conversation to the server once; it ignores
+# the call if it already has memory for this conversation
+def seed_companion_memory(conv_id):
+    try:
+        summaries = get_conversation_store().contexts(conv_id)
+        get_api_client().seed_memory(conv_id, summaries)
+        return True
+    except ApiError:
+        return False
+
+def delete_companion_memory(conv_id):
+    try:
+        get_api_client().delete_memory(conv_id)
+    except ApiError:
+        pass
+
 def generate_text(task_type, topic, length):
+    kind = task_type.lower()
+    if kind not in ("essay", "poem"):
+        return "Bad request"
     try:
-        if task_type.lower() == "essay":
-            response = requests.get(f"{BASE_URL}/essay", params={"topic": topic, "length": length})
-            if response.status_code == 200:
-                return response.json().get("essay", "Can't got the essay object")
-            else:
-                return "Bad request"
-        elif task_type.lower() == "poem":
-            response = requests.get(f"{BASE_URL}/poem", params={"topic": topic, "length": length})
-            if response.status_code == 200:
-                return response.json().get("poem", "Can't got the poem object")
-            else:
-                return "Bad request"
-        else:
-            return "Bad request"
-    except Exception:
+        return get_api_client().text(kind, topic, length).get(kind, f"Can't got the {kind} object")
+    except ApiStatusError:
+        return "Bad request"
+    except ApiError:
         return "API ERROR From Server"
 
+# ================================
+# Streaming API Call Functions
+# ================================
+
+# Raised by the streaming consumers when the server reports an error mid-stream
+class StreamError(Exception):
+    pass
+
+# Yields the essay/poem text piece by piece as the model writes it
+def stream_text(task_type, topic, length):
+    if task_type.lower() not in ("essay", "poem"):
+        raise StreamError("Bad request")
+    try:
+        for event, data in get_api_client().stream("GET", f"/{task_type.lower()}/stream",
+                                                    params={"topic": topic, "length": length}):
+            if event == "token":
+                yield data["text"]
+            elif event == "error":
+                raise StreamError(data["error"])
+    except ApiStatusError:
+        raise StreamError("Bad request")
+    except ApiError:
+        raise StreamError("API ERROR From Server-Client")
+
+# Yields ("token", text) while the answer streams in, then ("summary", (answer, context_summary))
+def stream_gemini_companion_api(user_input, conv_id):
+    try:
+        for event, data in get_api_client().stream("POST", "/companion/stream",
+                                                    params={"prompt": user_input, "conversation_id": conv_id}):
+            if event == "token":
+                yield "token", data["text"]
+            elif event == "summary":
+                yield "summary", (data["answer"], data["context_summary"])
+            elif event == "error":
+                raise StreamError(data["error"])
+    except ApiStatusError:
+        raise StreamError("Bad request")
+    except ApiError as e:
+        raise StreamError(str(e))
+
+# Returns the response ({"images": [...]} or {"error": ...}) like the endpoint does
 def generate_image(prompt, num_images):
-    response = requests.get(f"{BASE_URL}/generate-image", params={"prompt": prompt, "num_images": num_images})
-    return response.json()
+    try:
+        return get_api_client().generate_image(prompt, num_images)
+    except ApiError as e:
+        return {"error": str(e)}
+
+# ================================
+# Background Job Functions
+# ================================
+# Long generations run as server-side jobs. The job id is kept in session_state,
+# so a Streamlit rerun picks the same job up again instead of starting a new one.
+
+# Queue a job on /essay, /poem or /generate-image; returns the job id or None
+def submit_job(endpoint, params):
+    try:
+        return get_api_client().submit_job(endpoint, params)
+    except ApiError:
+        return None
+
+# Long-poll until the job finishes; returns its result, or None if it failed or expired
+def wait_for_job(job_id, timeout=600):
+    try:
+        job = get_api_client().wait_for_job(job_id, timeout)
+    except ApiError:
+        return None
+    return job["result"] if job["status"] == "done" else None
 
 
 # ================================
@@ -166,7 +234,9 @@ st.caption("Explore essays, poems, conversations, images, and audio in one place
 tab1, tab2, tab3, tab4 = st.tabs(["📝 Essay", "🎵 Poem", "🤖 Companion", "🖼 Image"])
 
 ESSAY_FILE = "../storage/essay.txt"
+JOB_MIN_WORDS = 150  # essays at least this long are generated as background jobs
 POEM_FILE = "../storage/poem.txt"
+HISTORY_PAGE = 20  # Companion turns shown when a conversation is opened; older ones load on demand
 
 # -------------------------------
 # Essay
@@ -175,34 +245,11 @@ with tab1:
     topic = st.text_input("Enter a topic for your essay:")
     length = st.slider("Select essay length (words)", 20, 300, 100)
 
-    # Load essay from session_state or file
-    if "essay_data" not in st.session_state:
-        last_essay_data = load_from_file(ESSAY_FILE)
-        st.session_state.essay_data = last_essay_data
-    else:
-        last_essay_data = st.session_state.essay_data
+    # Last essay, re-read only when the file changes
+    last_essay_data = load_from_file(ESSAY_FILE)
 
-    if st.button("Generate Essay", key="essay_btn"):
-        if topic:
-            essay = generate_text("essay", topic, length)
-            
-            # Handles the ERROR
-            if(essay == "Bad request" or essay == "API ERROR From Server" or 
-               essay == "Can't got the essay object" or essay =="API ERROR From Server-Client"):
-                st.error("Error generating essay.")
-                if last_essay_data:
-                    parts = last_essay_data.split('\n---\n', 1)
-                    if len(parts) == 2:
-                        last_topic, last_essay = parts
-                        st.subheader(f"Topic: {last_topic}")
-                        st.write(last_essay)
-            else:
-                # Save both topic and essay, separated by a special marker
-                save_to_file(ESSAY_FILE, f"{topic}\n---\n{essay}")
-                st.session_state.essay_data = f"{topic}\n---\n{essay}"
-                st.subheader(f"Topic: {topic}")
-                st.write(essay)
-    else:
+    # Show the previous essay when this one failed
+    def show_last_essay():
         if last_essay_data:
             parts = last_essay_data.split('\n---\n', 1)
             if len(parts) == 2:
@@ -210,22 +257,64 @@ with tab1:
                 st.subheader(f"Topic: {last_topic}")
                 st.write(last_essay)
 
+    def finish_essay(topic, essay):
+        # Handles the ERROR
+        if(not essay or essay == "Bad request" or essay == "API ERROR From Server" or 
+           essay == "Can't got the essay object" or essay =="API ERROR From Server-Client"):
+            st.error("Error generating essay.")
+            show_last_essay()
+        else:
+            # Save both topic and essay, separated by a special marker
+            save_to_file(ESSAY_FILE, f"{topic}\n---\n{essay}")
+
+    if st.button("Generate Essay", key="essay_btn"):
+        if topic:
+            if length >= JOB_MIN_WORDS:
+                # Long essays run as a background job (picked up again below)
+                job_id = submit_job("essay", {"topic": topic, "length": length})
+                if job_id:
+                    st.session_state.essay_job = (job_id, topic)
+                else:
+                    finish_essay(topic, "API ERROR From Server")
+            else:
+                # Render the essay as it streams in
+                try:
+                    st.subheader(f"Topic: {topic}")
+                    essay = st.write_stream(stream_text("essay", topic, length))
+                except StreamError:
+                    essay = "API ERROR From Server"
+                finish_essay(topic, essay)
+    elif "essay_job" not in st.session_state:
+        show_last_essay()
+
+    # A queued essay job, whether submitted in this run or before a rerun
+    if "essay_job" in st.session_state:
+        job_id, job_topic = st.session_state.essay_job
+        with st.spinner(f"Writing your essay on {job_topic}..."):
+            result = wait_for_job(job_id)
+        del st.session_state.essay_job
+        essay = result.get("essay", "Can't got the essay object") if result else "API ERROR From Server"
+        if essay not in ("API ERROR From Server", "Can't got the essay object"):
+            st.subheader(f"Topic: {job_topic}")
+            st.write(essay)
+        finish_essay(job_topic, essay)
+
 # -------------------------------
 # Poem
 # -------------------------------
 with tab2:
     topic = st.text_input("Enter a topic for your poem:")
     length = st.slider("Select poem length (words)", 5, 100, 30)
-    if "poem_data" not in st.session_state:
-        last_poem_data = load_from_file(POEM_FILE)
-        st.session_state.poem_data = last_poem_data
-    else:
-        last_poem_data = st.session_state.poem_data
+    last_poem_data = load_from_file(POEM_FILE)
 
     if st.button("Generate Poem", key="poem_btn"):
         if topic:
-            poem = generate_text("poem", topic, length)
-            if(poem == "Bad request" or poem == "API ERROR From Server" or 
+            try:
+                st.subheader(f"Topic: {topic}")
+                poem = st.write_stream(stream_text("poem", topic, length))
+            except StreamError:
+                poem = "API ERROR From Server"
+            if(not poem or poem == "Bad request" or poem == "API ERROR From Server" or 
                poem == "Can't got the poem object" or poem =="API ERROR From Server-Client"):
                 st.error("Error generating poem.")
                 if last_poem_data:
@@ -236,9 +325,6 @@ with tab2:
                         st.write(last_poem)
             else:
                 save_to_file(POEM_FILE, f"{topic}\n---\n{poem}")
-                st.session_state.poem_data = f"{topic}\n---\n{poem}"
-                st.subheader(f"Topic: {topic}")
-                st.write(poem)
     else:
         if last_poem_data:
             parts = last_poem_data.split('\n---\n', 1)
@@ -253,25 +339,14 @@ with tab2:
 with tab3:
     st.subheader("Your AI Companion")
 
-    # Cache conversations in session_state
-    if "conv_files" not in st.session_state:
-        conv_files = sorted(glob.glob(os.path.join(CONV_DIR, "*.txt")), key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-        st.session_state.conv_files = conv_files
-        st.session_state.conv_ids = [int(os.path.splitext(os.path.basename(f))[0]) for f in conv_files]
-    # Always define conv_files and conv_ids
-    conv_files = st.session_state.conv_files
-    conv_ids = st.session_state.conv_ids
+    # Cache the conversation index (ids and titles) in session_state
+    if "conv_index" not in st.session_state:
+        st.session_state.conv_index = list_conversations()
+    conv_ids = [conv["id"] for conv in st.session_state.conv_index]
+    conv_titles = {conv["id"]: conv["title"] for conv in st.session_state.conv_index}
 
     def conversation_name(conv_id):
-        # Cache exchanges per conversation
-        if f"exchanges_{conv_id}" not in st.session_state:
-            exchanges = load_conversation(conv_id)
-            st.session_state[f"exchanges_{conv_id}"] = exchanges
-        else:
-            exchanges = st.session_state[f"exchanges_{conv_id}"]
-        if exchanges and exchanges[0].get("prompt"):
-            return exchanges[0]["prompt"]
-        return "New Conversation"
+        return conv_titles.get(conv_id) or "New Conversation"
 
     # Handle empty conversations gracefully
     if conv_ids:
@@ -285,29 +360,53 @@ with tab3:
         st.info("No conversations found. Click 'New Conversation' to start.")
 
     if st.button("New Conversation"):
-        selected_conv = get_next_conversation_id()
-        save_conversation(selected_conv, [])
+        selected_conv = new_conversation()
         # Update session_state
-        st.session_state.conv_files = sorted(glob.glob(os.path.join(CONV_DIR, "*.txt")), key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-        st.session_state.conv_ids = [int(os.path.splitext(os.path.basename(f))[0]) for f in st.session_state.conv_files]
+        st.session_state.conv_index = list_conversations()
         st.session_state[f"exchanges_{selected_conv}"] = []
+        st.session_state[f"history_start_{selected_conv}"] = 0
         st.rerun()
 
     if selected_conv and st.button("Delete Conversation"):
         delete_conversation(selected_conv)
+        delete_companion_memory(selected_conv)
         # Update session_state
-        st.session_state.conv_files = sorted(glob.glob(os.path.join(CONV_DIR, "*.txt")), key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-        st.session_state.conv_ids = [int(os.path.splitext(os.path.basename(f))[0]) for f in st.session_state.conv_files]
-        if f"exchanges_{selected_conv}" in st.session_state:
-            del st.session_state[f"exchanges_{selected_conv}"]
+        st.session_state.conv_index = list_conversations()
+        st.session_state.pop(f"exchanges_{selected_conv}", None)
+        st.session_state.pop(f"history_start_{selected_conv}", None)
         st.rerun()
 
-    if selected_conv:
-        if f"exchanges_{selected_conv}" not in st.session_state:
-            exchanges = load_conversation(selected_conv)
-            st.session_state[f"exchanges_{selected_conv}"] = exchanges
-        else:
-            exchanges = st.session_state[f"exchanges_{selected_conv}"]
+    # Prepend the previous page of turns to the loaded history
+    def load_older(conv_id):
+        start = st.session_state[f"history_start_{conv_id}"]
+        new_start = max(0, start - HISTORY_PAGE)
+        older = load_conversation(conv_id, offset=new_start, limit=start - new_start)
+        st.session_state[f"exchanges_{conv_id}"][:0] = older
+        st.session_state[f"history_start_{conv_id}"] = new_start
+
+    # Only the last HISTORY_PAGE turns are read and rendered when a conversation is
+    # opened; older ones are loaded a page at a time. Runs as a fragment, so sending
+    # a message reruns just the chat instead of the whole page.
+    @st.fragment
+    def companion_chat(conv_id):
+        # A new title for the picker needs a full rerun
+        if st.session_state.pop("conv_index_changed", False):
+            st.rerun()
+
+        if f"exchanges_{conv_id}" not in st.session_state:
+            start = max(0, conversation_turns(conv_id) - HISTORY_PAGE)
+            st.session_state[f"exchanges_{conv_id}"] = load_conversation(conv_id, offset=start)
+            st.session_state[f"history_start_{conv_id}"] = start
+        exchanges = st.session_state[f"exchanges_{conv_id}"]
+        start = st.session_state[f"history_start_{conv_id}"]
+
+        if start:
+            st.button(
+                f"Show older messages ({start} more)",
+                key=f"companion_older_{conv_id}",
+                on_click=load_older,
+                args=(conv_id,)
+            )
 
         for ex in exchanges:
             if 'prompt' in ex:
@@ -318,7 +417,7 @@ with tab3:
         # --- Input field ---
         st.text_area(
             "Type your message...",
-            key=f"companion_input_{selected_conv}",
+            key=f"companion_input_{conv_id}",
             height=120
         )
 
@@ -327,69 +426,82 @@ with tab3:
         def handle_send(conv_id):
             user_input = st.session_state[f"companion_input_{conv_id}"]
             if user_input:
-                context = " ".join([ex['context'] for ex in exchanges if 'context' in ex])
-                answer, context_summary, error = get_gemini_companion_api(user_input, context)
+                if not st.session_state.get(f"memory_seeded_{conv_id}"):
+                    st.session_state[f"memory_seeded_{conv_id}"] = seed_companion_memory(conv_id)
+                answer, context_summary, error = get_gemini_companion_api(user_input, conv_id)
                 if error:
                     st.error(error)
                 else:
-                    exchanges.append({"prompt": user_input, "answer": answer, "context": context_summary})
-                    save_conversation(conv_id, exchanges)
-                    st.session_state[f"exchanges_{conv_id}"] = exchanges
+                    exchange = {"prompt": user_input, "answer": answer, "context": context_summary}
+                    save_exchange(conv_id, exchange)
+                    exchanges.append(exchange)
+                    # The first prompt becomes the title shown in the picker
+                    if start == 0 and len(exchanges) == 1:
+                        st.session_state.conv_index = list_conversations()
+                        st.session_state.conv_index_changed = True
 
             # ✅ Clear only the text area
             st.session_state[f"companion_input_{conv_id}"] = ""
 
         st.button(
                 "Send",
-                key=f"companion_send_{selected_conv}",
+                key=f"companion_send_{conv_id}",
                 on_click=handle_send,
-                args=(selected_conv,)
+                args=(conv_id,)
             )
 
+    if selected_conv:
+        companion_chat(selected_conv)
+
 # -------------------------------
 # Image
 # -------------------------------
 with tab4:
     img_prompt = st.text_input("Enter prompt for image generation:")
     num_images = st.slider("Number of images", min_value=1, max_value=5, value=3)
-    # Cache image info in session_state
-    if "images_info" not in st.session_state:
-        last_prompt, last_image_paths = load_images_info()
-        st.session_state.images_info = (last_prompt, last_image_paths)
-    else:
-        last_prompt, last_image_paths = st.session_state.images_info
+    last_prompt, last_image_paths = load_images_info()
+
+    def show_images(prompt, image_paths):
+        st.subheader(f"Prompt: {prompt}")
+        cols = st.columns(len(image_paths))
+        for idx, img_path in enumerate(image_paths, 1):
+            with cols[idx-1]:
+                st.image(img_path, use_container_width=True)
+                st.caption(f"Variation {idx}")
+
+    def show_image_error():
+        st.error("Error generating images.")
+        if last_image_paths:
+            show_images(last_prompt, last_image_paths)
 
     if st.button("Generate Image", key="img_btn"):
         if img_prompt:
-            result = generate_image(img_prompt, num_images)
-            if "error" in result or not result.get("images"):
-                st.error("Error generating images.")
-                if last_image_paths:
-                    st.subheader(f"Prompt: {last_prompt}")
-                    cols = st.columns(len(last_image_paths))
-                    for idx, img_path in enumerate(last_image_paths, 1):
-                        with cols[idx-1]:
-                            st.image(img_path, use_container_width=True)
-                            st.caption(f"Variation {idx}")
+            # A repeated prompt is served straight from the image store
+            image_paths = get_image_store().lookup_prompt(img_prompt, num_images)
+            if image_paths:
+                write_images_info(img_prompt, image_paths)
+                show_images(img_prompt, image_paths)
             else:
-                images = result["images"]
-                save_images_info(img_prompt, images)
-                image_paths = [os.path.join(IMAGES_DIR, f"{idx}.jpg") for idx in range(1, num_images+1)]
-                st.session_state.images_info = (img_prompt, image_paths)
-                st.subheader(f"Prompt: {img_prompt}")
-                cols = st.columns(num_images)
-                for idx in range(1, num_images+1):
-                    img_path = os.path.join(IMAGES_DIR, f"{idx}.jpg")
-                    with cols[idx-1]:
-                        st.image(img_path, use_container_width=True)
-                        st.caption(f"Variation {idx}")
-    else:
+                # Otherwise the images are generated by a background job (picked up again below)
+                job_id = submit_job("generate-image", {"prompt": img_prompt, "num_images": num_images})
+                if job_id:
+                    st.session_state.image_job = (job_id, img_prompt, num_images)
+                else:
+                    show_image_error()
+    elif "image_job" not in st.session_state:
         if last_image_paths:
-            st.subheader(f"Prompt: {last_prompt}")
-            cols = st.columns(len(last_image_paths))
-            for idx, img_path in enumerate(last_image_paths, 1):
-                with cols[idx-1]:
-                    st.image(img_path, use_container_width=True)
-                    st.caption(f"Variation {idx}")
-                    
-
+            show_images(last_prompt, last_image_paths)
+
+    # A queued image job, whether submitted in this run or before a rerun
+    if "image_job" in st.session_state:
+        job_id, job_prompt, job_num_images = st.session_state.image_job
+        with st.spinner(f"Generating images for {job_prompt}..."):
+            result = wait_for_job(job_id)
+            image_paths = []
+            if result and "error" not in result and result.get("images"):
+                image_paths = save_images_info(job_prompt, result["images"], job_num_images)
+        del st.session_state.image_job
+        if image_paths:
+            show_images(job_prompt, image_paths)
+        else:
+            show_image_error()
@@ -0,0 +1,112 @@
+# Response compression, zstd when the client's Accept-Encoding header lists it,
+# else gzip. Bodies under COMPRESS_MIN_BYTES go out as they are; streamed
+# responses (NDJSON batches and streams) are compressed chunk by chunk with a
+# flush after every chunk, so clients still get each line as soon as it is
+# written. Server-Sent-Events and responses that already carry a Content-Encoding
+# are passed through.
+import os
+import zlib
+
+import zstandard
+from starlette.datastructures import Headers, MutableHeaders
+
+from metrics import record_compression
+
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/plain")
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+
+
+# The encoding to use for an Accept-Encoding header, or None
+def negotiate(accept_encoding):
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ("zstd", "gzip"):
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+class Compressor:
+    def __init__(self, encoding):
+        if encoding == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._flush, self._finish = zstandard.COMPRESSOBJ_FLUSH_BLOCK, zstandard.COMPRESSOBJ_FLUSH_FINISH
+        else:
+            self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+            self._flush, self._finish = zlib.Z_SYNC_FLUSH, zlib.Z_FINISH
+
+    # Compressed bytes for `data`, flushed so the client can decode everything so far
+    def compress(self, data, final):
+        return self._obj.compress(data) + self._obj.flush(self._finish if final else self._flush)
+
+
+# Pure ASGI, installed outside MetricsMiddleware and CaptureMiddleware so they
+# see (and capture records) the uncompressed body.
+class CompressionMiddleware:
+    def __init__(self, app, min_size=1024):
+        self.app = app
+        self.min_size = min_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        compressor = None
+
+        async def send_wrapper(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows whether to compress
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if start is not None:
+                headers = MutableHeaders(raw=list(start.get("headers", [])))
+                content_type = headers.get("content-type", "").split(";")[0].strip()
+                if content_type in COMPRESSIBLE_TYPES:
+                    headers.add_vary_header("Accept-Encoding")
+                    if "content-encoding" not in headers and (more_body or len(body) >= self.min_size):
+                        compressor = Compressor(encoding)
+                        headers["content-encoding"] = encoding
+                if compressor is not None:
+                    data = compressor.compress(body, final=not more_body)
+                    if more_body:
+                        del headers["content-length"]
+                    else:
+                        headers["content-length"] = str(len(data))
+                await send({**start, "headers": headers.raw})
+                start = None
+            elif compressor is not None:
+                data = compressor.compress(body, final=not more_body)
+
+            if compressor is None:
+                return await send(message)
+            record_compression(encoding, len(body), len(data))
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
+
+
+# COMPRESS_MIN_BYTES from .env; None when COMPRESSION=0
+def compression_from_env():
+    if os.getenv("COMPRESSION", "1") != "1":
+        return None
+    return int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
@@ -0,0 +1,192 @@
+# SQLite-backed storage for Companion conversations.
+# Each exchange is one appended row, the conversations table doubles as the
+# index of ids, titles and turn counts, and ids come from AUTOINCREMENT so two
+# sessions can never allocate the same one. The legacy one-file-per-conversation
+# text format (PROMPT:/ANSWER:/CONTEXT: blocks) is imported once by migrate_text_dir().
+import glob
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT,
+    turns INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS exchanges (
+    conv_id INTEGER NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    prompt TEXT NOT NULL DEFAULT '',
+    answer TEXT NOT NULL DEFAULT '',
+    context TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (conv_id, seq)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+# Parse one legacy conversation text file into a list of exchanges
+def parse_text_conversation(path):
+    exchanges = []
+    with open(path, "r", encoding="utf-8") as f:
+        block = {}
+        for line in f:
+            if line.startswith("PROMPT:"):
+                block['prompt'] = line[len("PROMPT:"):].strip()
+            elif line.startswith("ANSWER:"):
+                block['answer'] = line[len("ANSWER:"):].strip()
+            elif line.startswith("CONTEXT:"):
+                block['context'] = line[len("CONTEXT:"):].strip()
+            elif line.strip() == "":
+                if block:
+                    exchanges.append(block)
+                    block = {}
+        if block:
+            exchanges.append(block)
+    return exchanges
+
+
+class ConversationStore:
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # One connection per thread (Streamlit runs every session on its own thread)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    # BEGIN IMMEDIATE takes the write lock up front, so read-then-write steps
+    # (like picking the next seq) can't interleave across threads or processes
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    # Allocate a new, empty conversation and return its id
+    def create(self, conv_id=None):
+        with self._transaction() as conn:
+            return self._create(conn, conv_id)
+
+    def _create(self, conn, conv_id):
+        now = time.time()
+        cursor = conn.execute(
+            "INSERT INTO conversations (id, created_at, updated_at) VALUES (?, ?, ?)", (conv_id, now, now)
+        )
+        return cursor.lastrowid
+
+    # Append one exchange; the first prompt becomes the conversation title
+    def append(self, conv_id, exchange):
+        with self._transaction() as conn:
+            self._append(conn, conv_id, exchange)
+
+    def _append(self, conn, conv_id, exchange):
+        row = conn.execute("SELECT turns FROM conversations WHERE id = ?", (conv_id,)).fetchone()
+        if row is None:
+            raise KeyError(conv_id)
+        conn.execute(
+            "INSERT INTO exchanges (conv_id, seq, prompt, answer, context) VALUES (?, ?, ?, ?, ?)",
+            (conv_id, row["turns"], exchange.get("prompt", ""), exchange.get("answer", ""), exchange.get("context", "")),
+        )
+        conn.execute(
+            "UPDATE conversations SET turns = turns + 1, updated_at = ?, title = COALESCE(title, NULLIF(?, '')) WHERE id = ?",
+            (time.time(), exchange.get("prompt", ""), conv_id),
+        )
+
+    # Exchanges in order; `offset`/`limit` read just a window of a long conversation
+    def load(self, conv_id, offset=0, limit=-1):
+        rows = self._connect().execute(
+            "SELECT prompt, answer, context FROM exchanges WHERE conv_id = ? ORDER BY seq LIMIT ? OFFSET ?",
+            (conv_id, limit, offset),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    # Number of exchanges, from the index row
+    def turns(self, conv_id):
+        row = self._connect().execute("SELECT turns FROM conversations WHERE id = ?", (conv_id,)).fetchone()
+        return row["turns"] if row else 0
+
+    # Just the context summaries, in order (what the server memory is seeded with)
+    def contexts(self, conv_id):
+        rows = self._connect().execute(
+            "SELECT context FROM exchanges WHERE conv_id = ? AND context != '' ORDER BY seq", (conv_id,)
+        ).fetchall()
+        return [row["context"] for row in rows]
+
+    # The index: [{"id", "title", "turns"}] ordered by id, without touching any exchange rows
+    def list(self):
+        rows = self._connect().execute("SELECT id, title, turns FROM conversations ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+
+    def delete(self, conv_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conv_id,))
+
+    # One-shot import of the legacy storage/conversations/<id>.txt files. Ids are
+    # preserved; the text files are left untouched and the import never runs twice.
+    # Each file is imported in one transaction, so an interrupted run leaves no
+    # half-imported conversation behind and the next run picks it up again.
+    def migrate_text_dir(self, conv_dir):
+        if self._connect().execute("SELECT 1 FROM meta WHERE key = 'text_migrated'").fetchone():
+            return 0
+        migrated = 0
+        for path in glob.glob(os.path.join(conv_dir, "*.txt")):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if not name.isdigit():
+                continue
+            conv_id = int(name)
+            exchanges = parse_text_conversation(path)
+            with self._transaction() as conn:
+                if conn.execute("SELECT 1 FROM conversations WHERE id = ?", (conv_id,)).fetchone():
+                    continue
+                self._create(conn, conv_id)
+                for exchange in exchanges:
+                    self._append(conn, conv_id, exchange)
+            migrated += 1
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('text_migrated', ?)", (str(time.time()),))
+        return migrated
+
+    # Closes the calling thread's connection
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Import legacy conversation text files into the SQLite store")
+    parser.add_argument("--conv-dir", default="../storage/conversations")
+    parser.add_argument("--db", default="../storage/conversations.db")
+    args = parser.parse_args()
+    count = ConversationStore(args.db).migrate_text_dir(args.conv_dir)
+    print(f"Migrated {count} conversation(s) into {args.db}")
@@ -0,0 +1,157 @@
+# Content-addressed image cache for the Image tab.
+# Images are downloaded concurrently over one pooled requests.Session (with
+# timeouts and retries) and saved as <sha256>.jpg, so identical images are stored
+# once. index.json maps image URLs and original prompts to those hashes, letting a
+# repeated prompt be served straight from disk, and the directory is kept under a
+# size limit by evicting the least recently used files.
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def make_session(pool_size=8, retries=3):
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class ImageStore:
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024, workers=5, timeout=(5, 60)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.timeout = timeout
+        self.session = make_session(pool_size=workers)
+        self._index_path = os.path.join(directory, "index.json")
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._index = self._read_index()
+
+    # -------------------------------
+    # Index
+    # -------------------------------
+    # {"urls": {image_url: hash}, "prompts": {prompt key: [hash, ...]}, "files": {hash: {"size", "last_used"}}}
+    def _read_index(self):
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {"urls": {}, "prompts": {}, "files": {}}
+
+    def _write_index(self):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f, ensure_ascii=False)
+        os.replace(tmp_path, self._index_path)
+
+    def path_for(self, digest):
+        return os.path.join(self.directory, f"{digest}.jpg")
+
+    def _touch(self, digest):
+        self._index["files"][digest]["last_used"] = time.time()
+
+    def _has(self, digest):
+        return digest in self._index["files"] and os.path.exists(self.path_for(digest))
+
+    @staticmethod
+    def prompt_key(prompt, num_images):
+        return f"{' '.join(prompt.split()).casefold()}|{num_images}"
+
+    # Paths saved earlier for the same original prompt and image count, or None
+    def lookup_prompt(self, prompt, num_images):
+        with self._lock:
+            digests = self._index["prompts"].get(self.prompt_key(prompt, num_images))
+            if not digests or not all(self._has(d) for d in digests):
+                return None
+            for digest in digests:
+                self._touch(digest)
+            self._write_index()
+            return [self.path_for(d) for d in digests]
+
+    # -------------------------------
+    # Downloads
+    # -------------------------------
+    def _download(self, url):
+        with self._lock:
+            digest = self._index["urls"].get(url)
+            if digest and self._has(digest):
+                self._touch(digest)
+                return self.path_for(digest)
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        content = response.content
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.path_for(digest)
+        with self._lock:
+            if not os.path.exists(path):
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+            self._index["files"][digest] = {"size": len(content), "last_used": time.time()}
+            self._index["urls"][url] = digest
+        return path
+
+    # Download every image at once; returns local paths in the same order (None on failure).
+    # The prompt entry is keyed by the requested `num_images` (the server may return
+    # fewer), so the same request finds it again with lookup_prompt().
+    def fetch_all(self, prompt, images, num_images=None):
+        def fetch(img):
+            try:
+                return self._download(img["image_url"])
+            except Exception as e:
+                print(f"Error downloading image {img['image_url']}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(images)))) as pool:
+            paths = list(pool.map(fetch, images))
+
+        with self._lock:
+            if paths and all(paths):
+                digests = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+                self._index["prompts"][self.prompt_key(prompt, num_images or len(images))] = digests
+            self._evict(keep=set(p for p in paths if p))
+            self._write_index()
+        return paths
+
+    # -------------------------------
+    # Eviction
+    # -------------------------------
+    # Drop least recently used files until the directory fits in max_bytes
+    def _evict(self, keep=()):
+        files = self._index["files"]
+        total = sum(info["size"] for info in files.values())
+        if total <= self.max_bytes:
+            return
+        for digest in sorted(files, key=lambda d: files[d]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            path = self.path_for(digest)
+            if path in keep:
+                continue
+            if os.path.exists(path):
+                os.remove(path)
+            total -= files.pop(digest)["size"]
+        # Forget URL and prompt entries that point at evicted files
+        self._index["urls"] = {u: d for u, d in self._index["urls"].items() if d in files}
+        self._index["prompts"] = {
+            p: ds for p, ds in self._index["prompts"].items() if all(d in files for d in ds)
+        }
@@ -0,0 +1,175 @@
+# Background jobs for long generations.
+# A job is queued and answered with its id right away; a fixed pool of worker
+# tasks (JOB_WORKERS) runs the queued jobs, and clients poll or long-poll for the
+# result. Finished jobs are kept for JOB_TTL seconds.
+# With a shared store (see shared_state.py) every status change is also published
+# there, so any worker process can answer GET /jobs/{id} for a job another one runs.
+# Store I/O is blocking, so it runs in threads: status changes go through a queue
+# drained in order by one publisher task, and reads use asyncio.to_thread.
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind, fn):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.fn = fn
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = asyncio.Event()
+
+    def to_dict(self):
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.status == "done":
+            data["result"] = self.result
+        elif self.status == "failed":
+            data["error"] = self.error
+        return data
+
+
+# A job owned by another worker process, as last published to the shared store
+class RemoteJob:
+    def __init__(self, data):
+        self.id = data["job_id"]
+        self.data = data
+
+    @property
+    def status(self):
+        return self.data["status"]
+
+    def to_dict(self):
+        return self.data
+
+
+class JobManager:
+    def __init__(self, workers=4, max_queue=1000, ttl=3600, store=None, poll_interval=0.25):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self.store = store
+        self.poll_interval = poll_interval
+        self._jobs = {}
+        self._queue = None
+        self._tasks = []
+        self._outbox = None  # (key, job dict) waiting to be published to the store
+        self._publisher = None
+
+    # Workers start with the first job, inside the server's event loop
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            self._publish(job)
+            try:
+                job.result = await job.fn()
+                job.status = "done"
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e) or type(e).__name__
+            finally:
+                job.finished_at = time.time()
+                job.finished.set()
+                self._publish(job)
+                self._queue.task_done()
+
+    def submit(self, kind, fn):
+        self._expire()
+        self._ensure_workers()
+        job = Job(kind, fn)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFull("Too many queued jobs")
+        self._jobs[job.id] = job
+        self._publish(job)
+        return job
+
+    def _publish(self, job):
+        if self.store is None:
+            return
+        if self._outbox is None:
+            self._outbox = asyncio.Queue()
+        if self._publisher is None or self._publisher.done():
+            self._publisher = asyncio.create_task(self._publish_loop())
+        self._outbox.put_nowait((f"job:{job.id}", job.to_dict()))
+
+    async def _publish_loop(self):
+        while True:
+            key, data = await self._outbox.get()
+            try:
+                await asyncio.to_thread(self.store.set, key, data, self.ttl)
+            except Exception as e:
+                logger.warning("Publishing %s to the shared store failed: %s", key, e)
+
+    async def get(self, job_id):
+        self._expire()
+        job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            data = await asyncio.to_thread(self.store.get, f"job:{job_id}")
+            job = RemoteJob(data) if data else None
+        return job
+
+    # Long-poll: wait up to `timeout` seconds for the job to finish
+    async def wait(self, job, timeout):
+        if isinstance(job, RemoteJob):
+            # Owned by another worker: poll the shared store
+            deadline = time.monotonic() + timeout
+            while job.status not in ("done", "failed") and time.monotonic() < deadline:
+                await asyncio.sleep(self.poll_interval)
+                job.data = await asyncio.to_thread(self.store.get, f"job:{job.id}") or job.data
+            return job
+        if timeout > 0 and not job.finished.is_set():
+            try:
+                await asyncio.wait_for(job.finished.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def snapshot(self):
+        counts = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"workers": self.workers, "queued": self._queue.qsize() if self._queue else 0, "jobs": counts}
+
+
+# Build the job manager from .env settings (JOB_WORKERS, JOB_QUEUE_MAX, JOB_TTL)
+def jobs_from_env(store=None):
+    return JobManager(
+        workers=int(os.getenv("JOB_WORKERS", "4")),
+        max_queue=int(os.getenv("JOB_QUEUE_MAX", "1000")),
+        ttl=int(os.getenv("JOB_TTL", "3600")),
+        store=store,
+    )
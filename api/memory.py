@@ -0,0 +1,234 @@
+# Server-side conversation memory for /companion.
+# Each conversation keeps its newest 25-word summaries verbatim and folds older
+# ones, in the background, into a single rolling summary. Prompts are built from
+# a token-budgeted window over that state, so the prompt size stays bounded no
+# matter how long the conversation gets. Several worker processes can share the
+# memory directory; writes are serialized across them with a file lock.
+import asyncio
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+# Rough token estimate (~4 characters per token) — good enough for budgeting
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+# Conversation ids become file names, so only allow a safe subset of characters
+def safe_id(conv_id):
+    conv_id = str(conv_id)
+    if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", conv_id):
+        raise ValueError(f"Invalid conversation id: {conv_id!r}")
+    return conv_id
+
+
+COMPACT_PROMPT = (
+    "Combine the following conversation memory into one summary of at most {words} words. "
+    "Keep every name, number and fact the user may ask about later.\n\n"
+    "Earlier summary:\n{rolling}\n\n"
+    "Newer notes:\n{notes}\n\n"
+    "Combined summary:"
+)
+
+
+# Exclusive lock on <directory>/.lock, held across worker processes (see serve.py)
+# so their read-modify-write cycles on the memory files don't interleave. Blocking:
+# call it from a thread, not on the event loop.
+@contextmanager
+def file_lock(directory):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".lock"), "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# Writes run in a thread under file_lock() and always start from the file on disk,
+# so appends from several worker processes are never lost. Cached states are
+# replaced, never changed in place, so readers on the event loop see whole states.
+class ConversationMemory:
+    def __init__(self, directory, token_budget=600, recent_turns=6, compact_words=120, max_cached=1024):
+        self.directory = directory
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.compact_words = compact_words
+        self.max_cached = max_cached
+        # Only the most recently used states are cached; the rest are reread from disk
+        self._states = OrderedDict()  # conv_id -> {"rolling": str, "recent": [str], "turns": int}
+        self._mtimes = {}  # conv_id -> mtime of the file the cached state was read from
+        self._mutex = threading.Lock()  # guards the two dicts above
+        self._write_lock = threading.Lock()
+        self._compacting = set()
+
+    def _path(self, conv_id):
+        return os.path.join(self.directory, f"{conv_id}.json")
+
+    def _read(self, conv_id):
+        state = {"rolling": "", "recent": [], "turns": 0}
+        path = self._path(conv_id)
+        if not os.path.exists(path):
+            return state, None
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, "r", encoding="utf-8") as f:
+            state.update(json.load(f))
+        return state, mtime
+
+    def _cache(self, conv_id, state, mtime):
+        with self._mutex:
+            self._states[conv_id] = state
+            self._states.move_to_end(conv_id)
+            self._mtimes[conv_id] = mtime
+            while len(self._states) > self.max_cached:
+                evicted, _ = self._states.popitem(last=False)
+                self._mtimes.pop(evicted, None)
+
+    # The cached state is reread when the file changed, e.g. written by another worker process
+    def load(self, conv_id):
+        conv_id = safe_id(conv_id)
+        path = self._path(conv_id)
+        mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+        with self._mutex:
+            if conv_id in self._states and self._mtimes.get(conv_id) == mtime:
+                self._states.move_to_end(conv_id)
+                return self._states[conv_id]
+        state, mtime = self._read(conv_id)
+        self._cache(conv_id, state, mtime)
+        return state
+
+    def _save(self, conv_id, state):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        # Write to a temp file and rename so a crash never leaves half a file behind
+        tmp_path = self._path(conv_id) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(conv_id))
+        self._cache(conv_id, state, os.stat(self._path(conv_id)).st_mtime_ns)
+
+    # Apply `change` (state -> True if it changed anything) to the state on disk
+    def _update(self, conv_id, change):
+        with self._write_lock, file_lock(self.directory):
+            state, _ = self._read(conv_id)
+            if not change(state):
+                return False
+            self._save(conv_id, state)
+            return True
+
+    # Prompt context: the rolling summary first, then as many of the newest
+    # summaries (kept in chronological order) as fit in the token budget.
+    def build_context(self, conv_id):
+        state = self.load(conv_id)
+        budget = self.token_budget
+        rolling = state["rolling"]
+        if rolling:
+            rolling = rolling[: budget * 4]
+            budget -= estimate_tokens(rolling)
+        picked = []
+        for summary in reversed(state["recent"]):
+            cost = estimate_tokens(summary)
+            if cost > budget:
+                break
+            picked.append(summary)
+            budget -= cost
+        parts = ([f"Earlier: {rolling}"] if rolling else []) + list(reversed(picked))
+        return " ".join(parts)
+
+    async def append(self, conv_id, summary):
+        conv_id = safe_id(conv_id)
+
+        def change(state):
+            state["recent"].append(summary)
+            state["turns"] += 1
+            return True
+
+        await asyncio.to_thread(self._update, conv_id, change)
+
+    # Initialise memory for a conversation the server hasn't seen yet (e.g. one
+    # created before memory moved server-side). Existing memory is left alone.
+    async def seed(self, conv_id, summaries):
+        conv_id = safe_id(conv_id)
+
+        def change(state):
+            if state["turns"]:
+                return False
+            state["recent"] = [s for s in summaries if s]
+            state["turns"] = len(state["recent"])
+            return True
+
+        return await asyncio.to_thread(self._update, conv_id, change)
+
+    async def delete(self, conv_id):
+        conv_id = safe_id(conv_id)
+
+        def remove():
+            with self._write_lock, file_lock(self.directory):
+                with self._mutex:
+                    self._states.pop(conv_id, None)
+                    self._mtimes.pop(conv_id, None)
+                path = self._path(conv_id)
+                if os.path.exists(path):
+                    os.remove(path)
+
+        await asyncio.to_thread(remove)
+
+    def needs_compaction(self, conv_id):
+        return len(self.load(conv_id)["recent"]) > self.recent_turns * 2
+
+    # Fold everything but the newest `recent_turns` summaries into the rolling
+    # summary. `summarize` is an async callable (prompt text -> summary text).
+    async def compact(self, conv_id, summarize):
+        conv_id = safe_id(conv_id)
+        if conv_id in self._compacting:
+            return
+        self._compacting.add(conv_id)
+        try:
+            state = self.load(conv_id)
+            old = state["recent"][: -self.recent_turns]
+            if not old:
+                return
+            rolling = await summarize(COMPACT_PROMPT.format(
+                words=self.compact_words, rolling=state["rolling"] or "(none)", notes="\n".join(old)
+            ))
+
+            # New turns may have been appended while we were summarizing; only drop what we folded in
+            def change(state):
+                if state["recent"][: len(old)] != old:
+                    return False
+                state["recent"] = state["recent"][len(old):]
+                state["rolling"] = rolling.strip()
+                return True
+
+            await asyncio.to_thread(self._update, conv_id, change)
+        finally:
+            self._compacting.discard(conv_id)
+
+
+# Build the memory from .env settings (MEMORY_DIR, MEMORY_TOKEN_BUDGET, MEMORY_RECENT_TURNS,
+# MEMORY_CACHE_SIZE)
+def memory_from_env():
+    return ConversationMemory(
+        os.getenv("MEMORY_DIR", "../storage/memory"),
+        token_budget=int(os.getenv("MEMORY_TOKEN_BUDGET", "600")),
+        recent_turns=int(os.getenv("MEMORY_RECENT_TURNS", "6")),
+        max_cached=int(os.getenv("MEMORY_CACHE_SIZE", "1024")),
+    )
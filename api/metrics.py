@@ -0,0 +1,397 @@
+# Prometheus-style metrics for the API server.
+# A small dependency-free implementation of counters, gauges and histograms in
+# the Prometheus text exposition format, plus an ASGI middleware that records
+# per-endpoint latency, in-flight requests and status codes, and can add a
+# Server-Timing header with the per-stage breakdown of a request.
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from starlette.routing import Match
+
+from resilience import upstream_status
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        return self.header() + [
+            f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}" for key, value in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = self.header()
+        for key, (counts, total, count) in self._values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', bound)])} {bucket_count}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    # Callbacks run just before rendering, e.g. to refresh gauges derived from other state
+    def add_collector(self, callback):
+        self._collectors.append(callback)
+
+    def render(self):
+        for callback in self._collectors:
+            callback()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# -------------------------------
+# Per-request context
+# -------------------------------
+# The middleware puts a RequestTiming in this context variable; code running for
+# the request adds stage timings to it, and they feed the stage histogram and the
+# optional Server-Timing header. Cache outcomes are noted too (for capture.py).
+class RequestTiming:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.cache = {}  # cache name -> last lookup result (hit, miss, bypass)
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self):
+        parts = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(parts)
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def current_endpoint():
+    timing = current_request.get()
+    return timing.endpoint if timing else "unknown"
+
+
+# -------------------------------
+# Metrics of this server
+# -------------------------------
+registry = Registry()
+
+REQUEST_LATENCY = registry.histogram(
+    "http_request_duration_seconds", "End-to-end request latency.", ["endpoint"])
+REQUESTS = registry.counter(
+    "http_requests_total", "Requests by endpoint and status code.", ["endpoint", "status"])
+IN_FLIGHT = registry.gauge(
+    "http_requests_in_flight", "Requests currently being served.", ["endpoint"])
+STAGE_LATENCY = registry.histogram(
+    "request_stage_duration_seconds", "Time spent in each stage of a request (queue, upstream, parse, ...).",
+    ["endpoint", "stage"])
+UPSTREAM_LATENCY = registry.histogram(
+    "upstream_request_duration_seconds", "Latency of the model calls alone.", ["endpoint"])
+PROMPT_TOKENS = registry.counter(
+    "llm_prompt_tokens_total", "Prompt tokens sent upstream.", ["endpoint"])
+COMPLETION_TOKENS = registry.counter(
+    "llm_completion_tokens_total", "Completion tokens received from upstream.", ["endpoint"])
+CACHE_LOOKUPS = registry.counter(
+    "cache_lookups_total", "Response cache lookups by result (hit, miss, bypass).", ["cache", "result"])
+CACHE_HIT_RATIO = registry.gauge(
+    "cache_hit_ratio", "Share of cache lookups answered from the cache.", ["cache"])
+ERRORS = registry.counter(
+    "errors_total", "Failed requests by category.", ["endpoint", "category"])
+SCHEDULER_LIMIT = registry.gauge(
+    "scheduler_concurrency_limit", "Current adaptive upstream concurrency window.")
+SCHEDULER_IN_FLIGHT = registry.gauge(
+    "scheduler_in_flight", "Upstream calls currently holding a permit.")
+SCHEDULER_QUEUED = registry.gauge(
+    "scheduler_queue_depth", "Calls waiting for an upstream permit.", ["priority"])
+RESILIENCE_EVENTS = registry.gauge(
+    "upstream_resilience_events", "Retry/hedge counters (calls, retries, hedges, hedge_wins, deadline_exceeded, budget_exhausted).",
+    ["event"])
+RETRY_BUDGET = registry.gauge(
+    "upstream_retry_budget_tokens", "Tokens left in the retry/hedge budget.")
+OUTPUT_PARSES = registry.counter(
+    "output_parse_total", "Model replies by how they were parsed (structured, json, scraper, failed).",
+    ["endpoint", "method"])
+SCHEDULER_EVENTS = registry.gauge(
+    "scheduler_events", "Scheduler counters (granted, rejected, timed_out, rate_limited, decreases).", ["event"])
+RESPONSE_BYTES = registry.counter(
+    "http_compressed_response_bytes_total", "Body bytes of compressed responses, before compression.",
+    ["endpoint", "encoding"])
+RESPONSE_SENT_BYTES = registry.counter(
+    "http_compressed_response_sent_bytes_total", "Body bytes of compressed responses as sent.",
+    ["endpoint", "encoding"])
+
+
+def _refresh_hit_ratios():
+    for cache in {key[0] for key in CACHE_LOOKUPS._values}:
+        hits = CACHE_LOOKUPS.get(cache=cache, result="hit")
+        misses = CACHE_LOOKUPS.get(cache=cache, result="miss")
+        CACHE_HIT_RATIO.set(hits / (hits + misses) if hits + misses else 0.0, cache=cache)
+
+
+registry.add_collector(_refresh_hit_ratios)
+
+
+# Export an UpstreamScheduler's state on every scrape
+def watch_scheduler(scheduler):
+    def collect():
+        snapshot = scheduler.snapshot()
+        SCHEDULER_LIMIT.set(snapshot["limit"])
+        SCHEDULER_IN_FLIGHT.set(snapshot["in_flight"])
+        for priority, depth in snapshot["queued"].items():
+            SCHEDULER_QUEUED.set(depth, priority=priority)
+        for event in ("granted", "rejected", "timed_out", "rate_limited", "decreases"):
+            SCHEDULER_EVENTS.set(snapshot[event], event=event)
+    registry.add_collector(collect)
+
+
+# Export a ResilientCaller's retry and hedge counters on every scrape
+def watch_resilience(caller):
+    def collect():
+        for event, value in caller.stats.items():
+            RESILIENCE_EVENTS.set(value, event=event)
+        RETRY_BUDGET.set(round(caller.budget.tokens, 2))
+    registry.add_collector(collect)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        timing = current_request.get()
+        if timing is not None:
+            timing.add(name, seconds)
+        STAGE_LATENCY.observe(seconds, endpoint=current_endpoint(), stage=name)
+
+
+def record_upstream(seconds, response=None):
+    endpoint = current_endpoint()
+    UPSTREAM_LATENCY.observe(seconds, endpoint=endpoint)
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        PROMPT_TOKENS.inc(usage.get("input_tokens", 0), endpoint=endpoint)
+        COMPLETION_TOKENS.inc(usage.get("output_tokens", 0), endpoint=endpoint)
+
+
+def record_cache(cache, result):
+    CACHE_LOOKUPS.inc(cache=cache, result=result)
+    timing = current_request.get()
+    if timing is not None:
+        timing.cache[cache] = result
+
+
+# Error categories: invalid_api_key, upstream_rate_limited, upstream_timeout, parse_failure,
+# server_busy, upstream_error. Upstream errors are told apart by their status code
+# (resilience.upstream_status), the same way the scheduler and the retry logic do;
+# only an invalid API key, which Gemini reports as a plain 400, is recognised by
+# its message.
+def classify_error(exc):
+    if type(exc).__name__ == "SchedulerBusy":
+        return "server_busy"
+    status = upstream_status(exc)
+    text = f"{exc} {exc.__cause__ or ''}"
+    if status in (401, 403) or "API key not valid" in text or "API_KEY_INVALID" in text or "Please pass a valid API key" in text:
+        return "invalid_api_key"
+    if status == 429:
+        return "upstream_rate_limited"
+    if isinstance(exc, TimeoutError) or status in (408, 504):
+        return "upstream_timeout"
+    return "upstream_error"
+
+
+def record_compression(encoding, raw, sent):
+    endpoint = current_endpoint()
+    RESPONSE_BYTES.inc(raw, endpoint=endpoint, encoding=encoding)
+    RESPONSE_SENT_BYTES.inc(sent, endpoint=endpoint, encoding=encoding)
+
+
+def record_parse(method):
+    OUTPUT_PARSES.inc(endpoint=current_endpoint(), method=method)
+
+
+def record_error(category):
+    ERRORS.inc(endpoint=current_endpoint(), category=category)
+
+
+# -------------------------------
+# Startup report
+# -------------------------------
+# Durations of the startup phases (imports, init, model, warmup), exported as a
+# gauge and served at /ready. `ready` is set once the app has finished starting.
+STARTUP_PHASES = registry.gauge(
+    "startup_phase_seconds", "Time spent in each startup phase (imports, init, model, warmup).", ["phase"])
+
+
+class StartupReport:
+    def __init__(self):
+        self.phases = {}
+        self.ready = False
+        self._last = time.perf_counter()
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+        STARTUP_PHASES.set(round(self.phases[name], 4), phase=name)
+
+    # Record the time since the previous mark (or since `start`) as phase `name`
+    def mark(self, name, start=None):
+        now = time.perf_counter()
+        self.add(name, now - (self._last if start is None else start))
+        self._last = now
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        return {name: round(seconds, 4) for name, seconds in self.phases.items()}
+
+    def summary(self):
+        return "Startup: " + ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.phases.items())
+
+
+startup = StartupReport()
+
+
+# -------------------------------
+# Middleware
+# -------------------------------
+# Pure ASGI (no response buffering, so streaming endpoints keep streaming).
+# Server-Timing is added when TIMING_HEADER=1 or the request sends "X-Timing: 1".
+class MetricsMiddleware:
+    def __init__(self, app, timing_header=None):
+        self.app = app
+        self.timing_header = timing_header if timing_header is not None else os.getenv("TIMING_HEADER", "0") == "1"
+
+    # Label requests by route template (e.g. /companion/memory/{conversation_id}) to keep cardinality bounded
+    def endpoint_for(self, scope):
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        endpoint = self.endpoint_for(scope)
+        timing = RequestTiming(endpoint)
+        token = current_request.set(timing)
+        want_header = self.timing_header or (b"x-timing", b"1") in scope.get("headers", [])
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if want_header:
+                    message = {**message, "headers": list(message.get("headers", [])) + [
+                        (b"server-timing", timing.server_timing().encode("latin-1"))
+                    ]}
+            await send(message)
+
+        IN_FLIGHT.inc(endpoint=endpoint)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            IN_FLIGHT.dec(endpoint=endpoint)
+            REQUESTS.inc(endpoint=endpoint, status=status)
+            REQUEST_LATENCY.observe(time.perf_counter() - timing.start, endpoint=endpoint)
+            current_request.reset(token)
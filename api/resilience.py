@@ -0,0 +1,176 @@
+# Deadlines, retries and hedging for upstream model calls.
+#   - Every call gets a deadline (UPSTREAM_DEADLINE, or per request); when it
+#     passes, the call is cancelled and UpstreamTimeout is raised.
+#   - Failures that are safe to repeat (timeouts, 429, 5xx, dropped connections)
+#     are retried with full-jitter exponential backoff, as long as the retry fits
+#     in the deadline.
+#   - With hedging on, if the first attempt hasn't answered by the observed p95
+#     latency, a second identical attempt is started and the first to succeed wins.
+# Retries and hedges both spend from a retry budget that only refills with
+# successful calls, so during an outage they stop instead of multiplying load.
+import asyncio
+import os
+import random
+from collections import deque
+
+
+class UpstreamTimeout(TimeoutError):
+    pass
+
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+# HTTP status behind an upstream error, or None. google.api_core exceptions (what
+# the Gemini client raises) carry it as `code`, HTTP client errors as `status_code`
+# or on their response; errors wrapped by LangChain are followed through __cause__.
+def upstream_status(exc):
+    while exc is not None:
+        for value in (getattr(exc, "code", None), getattr(exc, "status_code", None),
+                      getattr(getattr(exc, "response", None), "status_code", None)):
+            if isinstance(value, int) and not isinstance(value, bool):
+                return value
+        exc = exc.__cause__
+    return None
+
+
+# Failures where sending the same request again is safe and may succeed
+def is_retryable(exc):
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    return upstream_status(exc) in RETRYABLE_STATUS
+
+
+# Each success deposits `ratio` tokens (up to `capacity`); each retry or hedge
+# withdraws one. With ratio=0.1 extra attempts stay under ~10% of traffic.
+class RetryBudget:
+    def __init__(self, ratio=0.1, capacity=10.0):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+
+    def success(self):
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# Recent successful latencies per key (endpoint), used to pick the hedge delay
+class LatencyTracker:
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+
+    def record(self, key, seconds):
+        self._samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def p95(self, key):
+        samples = self._samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class ResilientCaller:
+    def __init__(self, deadline=60.0, max_retries=2, base_delay=0.25, max_delay=4.0,
+                 hedge=False, budget=None, tracker=None):
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.budget = budget or RetryBudget()
+        self.tracker = tracker or LatencyTracker()
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "deadline_exceeded": 0, "budget_exhausted": 0}
+
+    # `attempt` is an async zero-argument callable making one upstream call
+    async def call(self, attempt, key="default", deadline=None):
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + (deadline or self.deadline)
+        self.stats["calls"] += 1
+        retries = 0
+        while True:
+            try:
+                result = await self._until(attempt, key, deadline_at)
+                self.budget.success()
+                return result
+            except UpstreamTimeout:
+                self.stats["deadline_exceeded"] += 1
+                raise UpstreamTimeout(f"Upstream call exceeded its {deadline or self.deadline:.1f}s deadline") from None
+            except Exception as e:
+                if not is_retryable(e) or retries >= self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retries))
+                if loop.time() + delay >= deadline_at:
+                    raise
+                if not self.budget.withdraw():
+                    self.stats["budget_exhausted"] += 1
+                    raise
+                retries += 1
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+
+    # One attempt, cut off when the deadline passes. Only the deadline raises
+    # UpstreamTimeout; a TimeoutError from the attempt itself (asyncio.TimeoutError
+    # is the same class) is an ordinary, retryable failure.
+    async def _until(self, attempt, key, deadline_at):
+        loop = asyncio.get_running_loop()
+        remaining = deadline_at - loop.time()
+        if remaining > 0:
+            try:
+                return await asyncio.wait_for(self._attempt(attempt, key), remaining)
+            except TimeoutError:
+                if loop.time() < deadline_at:
+                    raise
+        raise UpstreamTimeout
+
+    # One logical attempt: the call itself, plus a hedge if it is slower than p95
+    async def _attempt(self, attempt, key):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        hedge_after = self.tracker.p95(key) if self.hedge else None
+        primary = asyncio.ensure_future(attempt())
+        tasks = {primary}
+        try:
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    if self.budget.withdraw():
+                        self.stats["hedges"] += 1
+                        tasks.add(asyncio.ensure_future(attempt()))
+                    else:
+                        self.stats["budget_exhausted"] += 1
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats["hedge_wins"] += 1
+                        self.tracker.record(key, loop.time() - start)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            # Cancel the losing (or abandoned) attempt so it releases its upstream permit
+            for task in tasks:
+                task.cancel()
+
+
+# Build the caller from .env settings
+def caller_from_env():
+    return ResilientCaller(
+        deadline=float(os.getenv("UPSTREAM_DEADLINE", "60")),
+        max_retries=int(os.getenv("UPSTREAM_RETRIES", "2")),
+        base_delay=float(os.getenv("RETRY_BASE_DELAY", "0.25")),
+        max_delay=float(os.getenv("RETRY_MAX_DELAY", "4")),
+        hedge=os.getenv("HEDGE_REQUESTS", "0") == "1",
+        budget=RetryBudget(ratio=float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))),
+        tracker=LatencyTracker(min_samples=int(os.getenv("HEDGE_MIN_SAMPLES", "20"))),
+    )
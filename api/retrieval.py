@@ -0,0 +1,206 @@
+# Retrieval memory for /companion.
+# Every stored summary is embedded and kept in a per-conversation FAISS index, so
+# a turn only needs the top-k most relevant memories plus the last few turns in
+# its prompt instead of the whole history. numpy and faiss are imported on first
+# use (or during warm-up), not when the app module is imported.
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from memory import file_lock, safe_id
+
+
+# -------------------------------
+# Embedders
+# -------------------------------
+# An embedder is anything with a `dim` attribute and an `embed(texts)` method that
+# returns a float32 array of shape (len(texts), dim) with L2-normalised rows.
+
+# Deterministic, dependency-free embedder: hashed character n-grams. Works offline
+# and gives the same vectors on every machine (Python's hash() is salted, so md5 is used).
+class HashingEmbedder:
+    def __init__(self, dim=256, ngrams=(3, 4)):
+        self.dim = dim
+        self.ngrams = ngrams
+
+    def _embed_one(self, text):
+        import numpy as np
+        vector = np.zeros(self.dim, dtype=np.float32)
+        text = f" {' '.join(text.casefold().split())} "
+        for n in self.ngrams:
+            for i in range(len(text) - n + 1):
+                digest = hashlib.md5(text[i:i + n].encode("utf-8")).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed(self, texts):
+        import numpy as np
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.stack([self._embed_one(t) for t in texts])
+
+
+# Adapter for any LangChain Embeddings object (e.g. GoogleGenerativeAIEmbeddings)
+class LangChainEmbedder:
+    def __init__(self, embeddings, dim):
+        self.embeddings = embeddings
+        self.dim = dim
+
+    def embed(self, texts):
+        import faiss
+        import numpy as np
+        vectors = np.asarray(self.embeddings.embed_documents(list(texts)), dtype=np.float32).reshape(-1, self.dim)
+        faiss.normalize_L2(vectors)
+        return vectors
+
+
+# Which embedder to use (EMBEDDINGS in .env): "hashing" (default, offline) or
+# "google" (GoogleGenerativeAIEmbeddings with EMBEDDING_MODEL, needs GOOGLE_API_KEY)
+def embedding_backend():
+    return os.getenv("EMBEDDINGS", "hashing")
+
+
+def embedder_from_env():
+    backend = embedding_backend()
+    if backend == "hashing":
+        return HashingEmbedder(dim=int(os.getenv("EMBEDDING_DIM", "256")))
+    if backend == "google":
+        from langchain_google_genai import GoogleGenerativeAIEmbeddings  # Only needed for EMBEDDINGS=google
+        model = os.getenv("EMBEDDING_MODEL", "models/text-embedding-004")
+        return LangChainEmbedder(GoogleGenerativeAIEmbeddings(model=model), dim=int(os.getenv("GOOGLE_EMBEDDING_DIM", "768")))
+    raise ValueError(f"Unknown EMBEDDINGS: {backend!r}")
+
+
+# -------------------------------
+# Per-conversation vector memory
+# -------------------------------
+# On disk each conversation has <id>.vec (raw float32 rows, append-only) and
+# <id>.jsonl (one summary per line), so adding a memory is an O(1) append. The
+# FAISS inner-product index (cosine similarity on normalised vectors) is rebuilt
+# from the vectors the first time a conversation is used, and again when the
+# files have grown since (another worker process added memories). Only the
+# `max_cached` most recently used indexes are kept in memory. Appends from several
+# worker processes are serialized with a file lock (see memory.file_lock), and
+# readers skip a line or vector another process is still writing. The methods
+# block, so the server calls them in a thread.
+class RetrievalMemory:
+    def __init__(self, directory, embedder, top_k=4, last_turns=2, max_cached=256):
+        self.directory = directory
+        self.embedder = embedder
+        self.top_k = top_k
+        self.last_turns = last_turns
+        self.max_cached = max_cached
+        self._indexes = OrderedDict()  # conv_id -> (faiss index, [summaries]), least recently used first
+        self._sizes = {}  # conv_id -> size of the .jsonl file the index was built from
+        self._lock = threading.Lock()
+
+    def _paths(self, conv_id):
+        base = os.path.join(self.directory, conv_id)
+        return base + ".vec", base + ".jsonl"
+
+    def _text_size(self, conv_id):
+        text_path = self._paths(conv_id)[1]
+        return os.path.getsize(text_path) if os.path.exists(text_path) else 0
+
+    def _load(self, conv_id):
+        import faiss
+        import numpy as np
+        size = self._text_size(conv_id)
+        if conv_id in self._indexes and self._sizes.get(conv_id) == size:
+            self._indexes.move_to_end(conv_id)
+            return self._indexes[conv_id]
+        index = faiss.IndexFlatIP(self.embedder.dim)
+        texts = []
+        vec_path, text_path = self._paths(conv_id)
+        if os.path.exists(vec_path) and os.path.exists(text_path):
+            with open(text_path, "r", encoding="utf-8") as f:
+                # A line without its newline is still being written
+                texts = [json.loads(line) for line in f if line.endswith("\n") and line.strip()]
+            vectors = np.fromfile(vec_path, dtype=np.float32)
+            vectors = vectors[: len(vectors) - len(vectors) % self.embedder.dim].reshape(-1, self.embedder.dim)
+            # Tolerate a crash (or a write in progress) between the two appends by trusting the shorter file
+            count = min(len(texts), len(vectors))
+            texts = texts[:count]
+            if count:
+                index.add(vectors[:count])
+        self._indexes[conv_id] = (index, texts)
+        self._indexes.move_to_end(conv_id)
+        self._sizes[conv_id] = size
+        while len(self._indexes) > self.max_cached:
+            evicted, _ = self._indexes.popitem(last=False)
+            self._sizes.pop(evicted, None)
+        return index, texts
+
+    def add(self, conv_id, summaries):
+        conv_id = safe_id(conv_id)
+        summaries = [s for s in summaries if s]
+        if not summaries:
+            return
+        vectors = self.embedder.embed(summaries)
+        with self._lock, file_lock(self.directory):
+            # Reloads first if another worker process appended since
+            index, texts = self._load(conv_id)
+            vec_path, text_path = self._paths(conv_id)
+            with open(text_path, "a", encoding="utf-8") as f:
+                for summary in summaries:
+                    f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+            with open(vec_path, "ab") as f:
+                f.write(vectors.tobytes())
+            index.add(vectors)
+            texts.extend(summaries)
+            self._sizes[conv_id] = self._text_size(conv_id)
+
+    def count(self, conv_id):
+        with self._lock:
+            return len(self._load(safe_id(conv_id))[1])
+
+    # Top-k memories most similar to `query`, skipping the newest `exclude_last` ones
+    def search(self, conv_id, query, k, exclude_last=0):
+        conv_id = safe_id(conv_id)
+        with self._lock:
+            index, texts = self._load(conv_id)
+            searchable = len(texts) - exclude_last
+            if searchable <= 0 or k <= 0:
+                return []
+            scores, ids = index.search(self.embedder.embed([query]), min(len(texts), k + exclude_last))
+            hits = [(float(s), int(i)) for s, i in zip(scores[0], ids[0]) if 0 <= i < searchable]
+            # Keep the chosen memories in chronological order
+            return [texts[i] for _, i in sorted(hits[:k], key=lambda hit: hit[1])]
+
+    # Prompt context: the most relevant older memories plus the last few turns verbatim
+    def build_context(self, conv_id, query):
+        relevant = self.search(conv_id, query, self.top_k, exclude_last=self.last_turns)
+        with self._lock:
+            recent = self._load(safe_id(conv_id))[1][-self.last_turns:] if self.last_turns else []
+        parts = []
+        if relevant:
+            parts.append("Relevant earlier memories: " + " ".join(relevant))
+        if recent:
+            parts.append("Most recent turns: " + " ".join(recent))
+        return "\n".join(parts)
+
+    def delete(self, conv_id):
+        conv_id = safe_id(conv_id)
+        with self._lock, file_lock(self.directory):
+            self._indexes.pop(conv_id, None)
+            self._sizes.pop(conv_id, None)
+            for path in self._paths(conv_id):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+# Build the retrieval memory from .env settings (MEMORY_DIR, RETRIEVAL_TOP_K, RETRIEVAL_LAST_TURNS,
+# RETRIEVAL_CACHE_SIZE, EMBEDDINGS). Vectors of different embedders don't mix, so each one gets its own directory.
+def retrieval_from_env(embedder=None):
+    backend = embedding_backend()
+    return RetrievalMemory(
+        os.path.join(os.getenv("MEMORY_DIR", "../storage/memory"), "vectors" if backend == "hashing" else f"vectors-{backend}"),
+        embedder or embedder_from_env(),
+        top_k=int(os.getenv("RETRIEVAL_TOP_K", "4")),
+        last_turns=int(os.getenv("RETRIEVAL_LAST_TURNS", "2")),
+        max_cached=int(os.getenv("RETRIEVAL_CACHE_SIZE", "256")),
+    )
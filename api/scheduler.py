@@ -0,0 +1,320 @@
+# Scheduler in front of the upstream model.
+# Every model call asks for a permit first. Permits are handed out in priority
+# order (interactive before bulk) while three limits allow it:
+#   - a token bucket on requests per minute (UPSTREAM_RPM)
+#   - a token bucket on tokens per minute (UPSTREAM_TPM), charged with an
+#     estimate up front and settled with the real usage afterwards
+#   - an adaptive concurrency window (AIMD): it grows by ~1 per window of
+#     successful calls and shrinks when upstream answers 429 or latency spikes
+# Waiters queue in a bounded priority queue; when it is full, or a caller has
+# waited longer than QUEUE_TIMEOUT, SchedulerBusy is raised with a Retry-After hint.
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+
+from resilience import upstream_status
+
+logger = logging.getLogger(__name__)
+
+
+INTERACTIVE = 0  # /companion, /generate-image: a user is waiting on the answer
+BULK = 1         # /essay, /poem, batch and background work
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+
+class SchedulerBusy(Exception):
+    def __init__(self, retry_after, reason="queue full"):
+        super().__init__(f"Upstream scheduler busy ({reason}), retry after {retry_after}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+# Upstream 429 / quota errors, as raised by the Gemini client or plain HTTP clients
+def is_rate_limited(exc):
+    return upstream_status(exc) == 429
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until `amount` can be taken (0 when it can be taken now)
+    def wait_time(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.level -= amount
+
+    # Return unused tokens (or charge more) once the real cost is known
+    def adjust(self, delta):
+        self.level = min(self.capacity, self.level + delta)
+
+
+# Per-minute limit counted in the shared store (see shared_state.py), so UPSTREAM_RPM
+# and UPSTREAM_TPM hold across all worker processes. Same interface as TokenBucket:
+# calls are counted in one-minute windows and the previous window still counts for
+# the share of it that lies within the last 60 seconds (a sliding-window estimate),
+# so a full window doesn't let a second burst through right after the boundary.
+#
+# The store is never touched on the event loop: take/adjust only add to a local
+# tally, and a background task (started on first use) pushes the tally and reads
+# back the shared counts every `sync_interval` seconds in a thread. Workers can
+# therefore overshoot the limit by about what they admit within one interval.
+class SharedWindow:
+    def __init__(self, store, name, per_minute, sync_interval=0.5):
+        self.store = store
+        self.name = name
+        self.capacity = per_minute
+        self.sync_interval = sync_interval
+        self._counts = {}  # window -> shared count as of the last sync
+        self._pending = {}  # window -> local amount not yet pushed to the store
+        self._lock = threading.Lock()  # sync() runs in a worker thread
+        self._task = None
+
+    def _key(self, window):
+        return f"limit:{self.name}:{window}"
+
+    def _used(self, window):
+        return self._counts.get(window, 0) + self._pending.get(window, 0)
+
+    def wait_time(self, amount):
+        self._ensure_sync()
+        now = time.time()
+        window, elapsed = int(now // 60), now % 60 / 60
+        amount = min(amount, self.capacity)
+        with self._lock:
+            spare = self.capacity - self._used(window) - amount
+            previous = self._used(window - 1)
+        if previous * (1 - elapsed) <= spare:
+            return 0.0
+        if spare < 0:
+            return 60 - now % 60
+        # Until enough of the previous window has slid out
+        return (1 - spare / previous - elapsed) * 60
+
+    def take(self, amount):
+        self._add(amount)
+
+    def adjust(self, delta):
+        self._add(-delta)
+
+    def _add(self, amount):
+        self._ensure_sync()
+        window = int(time.time() // 60)
+        with self._lock:
+            self._pending[window] = self._pending.get(window, 0) + amount
+
+    # Push the local tally and read back the shared counts (blocking store I/O)
+    def sync(self):
+        with self._lock:
+            pushing = dict(self._pending)
+        counts = {window: self.store.incr(self._key(window), amount, ttl=180)
+                  for window, amount in pushing.items() if amount}
+        window = int(time.time() // 60)
+        for w in (window - 1, window):
+            if w not in counts:
+                counts[w] = self.store.get(self._key(w)) or 0
+        with self._lock:
+            for w, amount in pushing.items():
+                left = self._pending.pop(w) - amount
+                if left:
+                    self._pending[w] = left
+            self._counts = {w: count for w, count in counts.items() if w >= window - 1}
+
+    def _ensure_sync(self):
+        if self._task is None or self._task.done():
+            try:
+                self._task = asyncio.get_running_loop().create_task(self._sync_loop())
+            except RuntimeError:  # no event loop (e.g. in tests); call sync() directly
+                pass
+
+    async def _sync_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sync)
+            except Exception as e:
+                # Keep the local tally and try again; the limits stay approximate meanwhile
+                logger.warning("Shared rate-limit sync failed: %s", e)
+            await asyncio.sleep(self.sync_interval)
+
+
+class Permit:
+    __slots__ = ("priority", "cost", "granted_at")
+
+    def __init__(self, priority, cost):
+        self.priority = priority
+        self.cost = cost
+        self.granted_at = None
+
+
+class UpstreamScheduler:
+    def __init__(self, max_concurrency=32, min_concurrency=1, rpm=0, tpm=0,
+                 max_queue=256, queue_timeout=30.0, spike_factor=3.0, store=None):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        # With a shared store the per-minute limits are shared by all worker processes
+        if store is not None:
+            self.requests = SharedWindow(store, "requests", rpm) if rpm else None
+            self.tokens = SharedWindow(store, "tokens", tpm) if tpm else None
+        else:
+            self.requests = TokenBucket(rpm) if rpm else None
+            self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.spike_factor = spike_factor
+        self.in_flight = 0
+        self.baseline_latency = None  # slow EWMA of successful call latency
+        self.stats = {"granted": 0, "rejected": 0, "timed_out": 0, "rate_limited": 0, "decreases": 0}
+        self._queue = []  # (priority, seq, permit, future)
+        self._seq = itertools.count()
+        self._timer = None
+
+    # -------------------------------
+    # Acquire / release
+    # -------------------------------
+    async def acquire(self, priority=BULK, cost=0):
+        if self.queue_depth() >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise SchedulerBusy(self.retry_after())
+        permit = Permit(priority, cost)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), permit, future))
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not self._abandon(future):
+                return permit
+            self.stats["timed_out"] += 1
+            raise SchedulerBusy(self.retry_after(), reason="queue timeout")
+        except asyncio.CancelledError:
+            # Caller went away; hand the permit straight back if it was already granted
+            if not self._abandon(future):
+                self.release(permit)
+            raise
+        return permit
+
+    # Cancel a waiting future; False if it had already been granted
+    def _abandon(self, future):
+        if future.done():
+            return False
+        future.cancel()
+        return True
+
+    def release(self, permit, latency=None, error=None, tokens_used=None):
+        self.in_flight -= 1
+        if self.tokens is not None and tokens_used is not None:
+            self.tokens.adjust(permit.cost - tokens_used)
+        if error is not None and is_rate_limited(error):
+            self.stats["rate_limited"] += 1
+            self._decrease(0.5)
+        elif error is None and latency is not None:
+            self._observe_latency(latency)
+        self._dispatch()
+
+    # -------------------------------
+    # Adaptive concurrency (AIMD)
+    # -------------------------------
+    def _observe_latency(self, latency):
+        if self.baseline_latency is None:
+            self.baseline_latency = latency
+            return
+        if latency > self.baseline_latency * self.spike_factor:
+            self._decrease(0.9)
+        else:
+            self.limit = min(self.max_concurrency, self.limit + 1.0 / max(self.limit, 1.0))
+        self.baseline_latency += 0.05 * (latency - self.baseline_latency)
+
+    def _decrease(self, factor):
+        self.stats["decreases"] += 1
+        self.limit = max(self.min_concurrency, self.limit * factor)
+
+    # -------------------------------
+    # Dispatch
+    # -------------------------------
+    def _dispatch(self):
+        while self._queue:
+            _, _, permit, future = self._queue[0]
+            if future.done():  # abandoned waiter
+                heapq.heappop(self._queue)
+                continue
+            if self.in_flight >= max(self.min_concurrency, int(self.limit)):
+                return
+            wait = max(
+                self.requests.wait_time(1) if self.requests else 0.0,
+                self.tokens.wait_time(permit.cost) if self.tokens else 0.0,
+            )
+            if wait > 0:
+                self._wake_in(wait)
+                return
+            heapq.heappop(self._queue)
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(permit.cost)
+            self.in_flight += 1
+            self.stats["granted"] += 1
+            permit.granted_at = time.monotonic()
+            future.set_result(None)
+
+    def _wake_in(self, delay):
+        if self._timer is not None and not self._timer.cancelled():
+            return
+        def wake():
+            self._timer = None
+            self._dispatch()
+        self._timer = asyncio.get_running_loop().call_later(delay, wake)
+
+    # -------------------------------
+    # Introspection
+    # -------------------------------
+    def queue_depth(self, priority=None):
+        return sum(1 for p, _, _, f in self._queue if not f.done() and (priority is None or p == priority))
+
+    def is_full(self):
+        return self.queue_depth() >= self.max_queue
+
+    # Rough time for the current queue to drain at the current window and latency
+    def retry_after(self):
+        latency = self.baseline_latency or 1.0
+        return max(1, math.ceil(self.queue_depth() * latency / max(self.limit, 1.0)))
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": {name: self.queue_depth(p) for p, name in PRIORITY_NAMES.items()},
+            "baseline_latency_s": round(self.baseline_latency, 3) if self.baseline_latency else None,
+        }
+
+
+# Build the scheduler from .env settings. MAX_CONCURRENCY is the total for the
+# server, so with several workers each one gets an equal share of it.
+def scheduler_from_env(store=None, workers=1):
+    return UpstreamScheduler(
+        max_concurrency=max(1, int(os.getenv("MAX_CONCURRENCY", "32")) // workers),
+        min_concurrency=int(os.getenv("UPSTREAM_MIN_CONCURRENCY", "1")),
+        rpm=int(os.getenv("UPSTREAM_RPM", "0")),
+        tpm=int(os.getenv("UPSTREAM_TPM", "0")),
+        max_queue=int(os.getenv("QUEUE_MAX", "256")),
+        queue_timeout=float(os.getenv("QUEUE_TIMEOUT", "30")),
+        store=store,
+    )
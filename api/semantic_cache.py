@@ -0,0 +1,144 @@
+# Semantic (near-duplicate) cache for /companion and /generate-image.
+# The exact-key response cache only helps when a request repeats word for word.
+# Here the normalised request text is embedded and looked up in a FAISS
+# inner-product index; a cached result is reused when the cosine similarity of
+# the closest earlier request is at least the endpoint's threshold.
+# Everything that has to match exactly (model, prompt template, context,
+# number of images, ...) goes into a `scope` string; each scope has its own index.
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from retrieval import embedder_from_env, embedding_backend
+
+
+# Words that carry no meaning for the lookup ("a cat on the roof" == "cat on roof")
+STOPWORDS = frozenset(
+    "a an the of on in at to for with and or is are was be please me my i you can could would".split()
+)
+
+
+def normalize_request(text):
+    words = re.sub(r"[^\w\s]", " ", text.casefold()).split()
+    return " ".join(word for word in words if word not in STOPWORDS) or " ".join(words)
+
+
+# Fingerprint of the parts of a request that must match exactly
+def make_scope(*parts):
+    return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class SemanticCache:
+    def __init__(self, embedder, thresholds, ttl=3600, max_entries=2048):
+        self.embedder = embedder
+        self.thresholds = thresholds  # endpoint -> minimum cosine similarity (0 disables it)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._indexes = {}  # (endpoint, scope) -> faiss.IndexIDMap
+        self._entries = OrderedDict()  # id -> (endpoint, scope, text, value, expires_at), oldest first
+        self._ids = iter(range(1, 2 ** 62))
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0}
+
+    def enabled(self, endpoint):
+        return self.thresholds.get(endpoint, 0) > 0
+
+    # Returns (value, similarity) of the closest live entry above the threshold, or (None, score)
+    def get(self, endpoint, scope, text):
+        vector = self.embedder.embed([normalize_request(text)])
+        with self._lock:
+            index = self._indexes.get((endpoint, scope))
+            best = 0.0
+            if index is not None and index.ntotal:
+                scores, ids = index.search(vector, min(index.ntotal, 4))
+                now = time.time()
+                for score, entry_id in zip(scores[0], ids[0]):
+                    entry = self._entries.get(int(entry_id))
+                    if entry is None:
+                        continue
+                    if entry[4] < now:
+                        self._remove(int(entry_id))
+                        continue
+                    best = max(best, float(score))
+                    if score >= self.thresholds[endpoint]:
+                        self._entries.move_to_end(int(entry_id))
+                        self.stats["hits"] += 1
+                        return entry[3], float(score)
+            self.stats["misses"] += 1
+            return None, best
+
+    def set(self, endpoint, scope, text, value):
+        normalized = normalize_request(text)
+        vector = self.embedder.embed([normalized])
+        import faiss  # Imported on first use, like in retrieval.py
+        import numpy as np
+        with self._lock:
+            index = self._indexes.get((endpoint, scope))
+            if index is None:
+                index = self._indexes[(endpoint, scope)] = faiss.IndexIDMap(faiss.IndexFlatIP(self.embedder.dim))
+            entry_id = next(self._ids)
+            index.add_with_ids(vector, np.array([entry_id], dtype=np.int64))
+            self._entries[entry_id] = (endpoint, scope, normalized, value, time.time() + self.ttl)
+            self.stats["sets"] += 1
+            self._evict()
+
+    def _remove(self, entry_id):
+        import numpy as np
+        endpoint, scope, _, _, _ = self._entries.pop(entry_id)
+        index = self._indexes[(endpoint, scope)]
+        index.remove_ids(np.array([entry_id], dtype=np.int64))
+        if not index.ntotal:
+            del self._indexes[(endpoint, scope)]
+
+    # Drop expired entries first, then the least recently used ones
+    def _evict(self):
+        if len(self._entries) <= self.max_entries:
+            return
+        now = time.time()
+        for entry_id in [i for i, entry in self._entries.items() if entry[4] < now]:
+            self._remove(entry_id)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._entries.clear()
+
+    def snapshot(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            "thresholds": self.thresholds,
+        }
+
+
+# Default thresholds per embedder (EMBEDDINGS). Hashed n-grams compare spelling, not
+# meaning: "old man smiling" and "old woman smiling" score 0.92 while a reworded
+# request scores under 0.5, so with them the cache is off unless a threshold is set.
+DEFAULT_THRESHOLDS = {
+    "hashing": {"companion": 0.0, "generate-image": 0.0},
+    "google": {"companion": 0.95, "generate-image": 0.92},
+}
+
+
+# Build the semantic cache from .env settings (SEMANTIC_THRESHOLD_COMPANION,
+# SEMANTIC_THRESHOLD_IMAGE, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_MAX_ENTRIES, EMBEDDINGS)
+def semantic_cache_from_env(embedder=None):
+    defaults = DEFAULT_THRESHOLDS.get(embedding_backend(), DEFAULT_THRESHOLDS["hashing"])
+    return SemanticCache(
+        embedder or embedder_from_env(),
+        thresholds={
+            "companion": float(os.getenv("SEMANTIC_THRESHOLD_COMPANION", defaults["companion"])),
+            "generate-image": float(os.getenv("SEMANTIC_THRESHOLD_IMAGE", defaults["generate-image"])),
+        },
+        ttl=int(os.getenv("SEMANTIC_CACHE_TTL", "3600")),
+        max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2048")),
+    )
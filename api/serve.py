@@ -0,0 +1,31 @@
+# Multi-worker entry point for the API server.
+#   python serve.py --workers 4 --host 0.0.0.0 --port 8000
+# Each worker is a separate process with its own event loop, so CPU-bound work
+# (JSON, parsing, embeddings) scales with cores. State that has to agree across
+# workers (upstream rate limits, job records, response cache) lives in the shared
+# store (STATE_BACKEND, see shared_state.py). In-process state such as the first
+# cache tier, the semantic cache and the /metrics counters stays per worker.
+import argparse
+import os
+
+import uvicorn
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the API server with several uvicorn workers")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+                        help="Worker processes (default: WEB_CONCURRENCY or the number of CPUs)")
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"), help="Bind address (default: HOST or 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")), help="Port (default: PORT or 8000)")
+    args = parser.parse_args()
+
+    # Workers inherit the environment; app.py splits per-process limits between them
+    os.environ["SERVER_WORKERS"] = str(args.workers)
+    uvicorn.run(
+        "app:create_app",
+        factory=True,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+    )
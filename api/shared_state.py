@@ -0,0 +1,186 @@
+# Shared state for running several uvicorn workers (see serve.py).
+# Whatever has to agree across worker processes (upstream rate-limit counters,
+# job records, and with Redis the second response-cache tier) goes through a
+# small key-value store with JSON values, TTLs and atomic counters:
+#   sqlite (default) - a WAL-mode SQLite file (STATE_DB), shared by the workers of one host
+#   redis            - a Redis-compatible server (REDIS_URL), shared across hosts; needs
+#                      the `redis` package. REDIS_URL=local:// uses LocalRedis instead,
+#                      an in-process stand-in for tests and single-process runs.
+# A single worker keeps all of that in process memory; the store is only used with
+# several workers (SERVER_WORKERS > 1) or when STATE_BACKEND is set explicitly.
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SqliteStore:
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # One connection per thread; WAL lets the workers read while one of them writes
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), time.time() + ttl if ttl else None),
+        )
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM state WHERE key = ?", (key,))
+
+    # Atomically add `amount` to a numeric value (missing or expired counts as 0)
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)", (key, now)
+            ).fetchone()
+            value = (json.loads(row[0]) if row else 0) + amount
+            conn.execute(
+                "INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now + ttl if ttl else None),
+            )
+            # Expired rows are swept along with the writes
+            conn.execute("DELETE FROM state WHERE expires_at < ?", (now,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+
+class RedisStore:
+    def __init__(self, client, prefix="simple-chatbot:"):
+        self.client = client  # redis.Redis(decode_responses=True) or LocalRedis
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key, amount=1, ttl=None):
+        value = float(self.client.incrbyfloat(self.prefix + key, amount))
+        if ttl:
+            self.client.expire(self.prefix + key, int(ttl))
+        return value
+
+
+# The subset of the redis-py client used by RedisStore, kept in process memory
+class LocalRedis:
+    def __init__(self):
+        self._data = {}  # key -> (value, expires_at or None)
+        self._lock = threading.Lock()
+
+    def _live(self, name):
+        item = self._data.get(name)
+        if item is not None and item[1] is not None and item[1] < time.time():
+            del self._data[name]
+            return None
+        return item
+
+    def get(self, name):
+        with self._lock:
+            item = self._live(name)
+            return item[0] if item else None
+
+    def set(self, name, value, ex=None):
+        with self._lock:
+            self._data[name] = (str(value), time.time() + ex if ex else None)
+        return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(1 for name in names if self._data.pop(name, None) is not None)
+
+    def incrbyfloat(self, name, amount):
+        with self._lock:
+            item = self._live(name)
+            value = (float(item[0]) if item else 0.0) + amount
+            self._data[name] = (repr(value), item[1] if item else None)
+            return value
+
+    def expire(self, name, seconds):
+        with self._lock:
+            item = self._live(name)
+            if item is None:
+                return False
+            self._data[name] = (item[0], time.time() + seconds)
+            return True
+
+
+# Build the store from .env settings (STATE_BACKEND, STATE_DB, REDIS_URL)
+def store_from_env():
+    backend = os.getenv("STATE_BACKEND", "sqlite")
+    if backend == "sqlite":
+        return SqliteStore(os.getenv("STATE_DB", "../storage/state.db"))
+    if backend == "redis":
+        url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        if url.startswith("local://"):
+            return RedisStore(LocalRedis())
+        import redis  # Optional dependency, only needed for STATE_BACKEND=redis
+        return RedisStore(redis.Redis.from_url(url, decode_responses=True))
+    raise ValueError(f"Unknown STATE_BACKEND: {backend!r}")
+
+
+# Whether the workers need the shared store: more than one of them, or a backend
+# chosen explicitly in .env
+def shared_state_enabled(workers=1):
+    return workers > 1 or bool(os.getenv("STATE_BACKEND"))
+
+
+# Opens the store from .env on first use, so importing the app has no side effects
+class LazyStore:
+    def __init__(self, factory=store_from_env):
+        self.factory = factory
+
+    @functools.cached_property
+    def store(self):
+        return self.factory()
+
+    def open(self):
+        return self.store
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.store.set(key, value, ttl=ttl)
+
+    def delete(self, key):
+        self.store.delete(key)
+
+    def incr(self, key, amount=1, ttl=None):
+        return self.store.incr(key, amount, ttl=ttl)
@@ -0,0 +1,34 @@
+# Request coalescing ("single flight") for identical in-flight generations.
+# Concurrent callers with the same key share one upstream call and all receive
+# its result. The shared call runs as its own task and every caller awaits it
+# through asyncio.shield, so a caller that times out or disconnects only stops
+# waiting; the call keeps running for everyone else. Each caller can pass its own
+# `timeout`; it only bounds that caller's wait, never the shared call.
+import asyncio
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}  # key -> asyncio.Task
+        self.stats = {"leaders": 0, "followers": 0}
+
+    async def do(self, key, fn, timeout=None):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.stats["leaders"] += 1
+        else:
+            self.stats["followers"] += 1
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception as retrieved in case every caller already gave up
+        if not task.cancelled():
+            task.exception()
+
+    def in_flight(self):
+        return len(self._calls)
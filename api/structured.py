@@ -0,0 +1,191 @@
+# Structured output for /companion and /generate-image.
+# The model is asked for a JSON object matching a schema, through LangChain's
+# with_structured_output (function calling) where the model supports it, or
+# through the prompt otherwise. Replies are parsed tolerantly: the parsed tool
+# call first, then any JSON object in the reply text (code fences, leading chatter
+# and truncated JSON are accepted). When both fail the caller falls back to the
+# old line scraper, so a reply in the wrong shape no longer costs a new request.
+import json
+import re
+
+from pydantic import BaseModel, Field, ValidationError
+
+
+class CompanionReply(BaseModel):
+    """Answer to the user's prompt plus a summary of the exchange for future memory."""
+    answer: str = Field(description="The answer to the user's prompt")
+    summary: str = Field(description="Exactly 25 words summarizing both the user's request and the answer")
+
+
+class ImagePrompts(BaseModel):
+    """Distinct prompts for an image generator."""
+    prompts: list[str] = Field(description="One self-contained image generation prompt per item")
+
+
+# Runnable returning {"raw", "parsed", "parsing_error"} with function calling, or
+# the plain model when it has no tool support (the prompt then asks for JSON).
+def structured_runnable(model, schema):
+    try:
+        return model.with_structured_output(schema, include_raw=True)
+    except NotImplementedError:
+        return model
+
+
+# The AIMessage behind a plain or an include_raw=True structured response
+def raw_message(response):
+    return response.get("raw") if isinstance(response, dict) else response
+
+
+def message_text(response):
+    content = getattr(raw_message(response), "content", "")
+    if isinstance(content, list):  # multi-part content
+        content = "".join(part if isinstance(part, str) else part.get("text", "") for part in content)
+    return content or ""
+
+
+# First JSON object in `text`, possibly fenced or cut off; None if there is none
+def parse_json_text(text):
+    start = text.find("{")
+    if start < 0:
+        return None
+    from langchain_core.utils.json import parse_partial_json  # Imported on first use, keeps `import app` light
+    try:
+        data = parse_partial_json(text[start:])
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+# (instance, method): method is "structured" (function calling), "json" (JSON in
+# the reply text) or None when the reply has to go to the fallback scraper
+def parse_structured(response, schema):
+    if isinstance(response, dict) and isinstance(response.get("parsed"), schema):
+        return response["parsed"], "structured"
+    candidates = [(call.get("args"), "structured") for call in getattr(raw_message(response), "tool_calls", None) or []]
+    candidates.append((parse_json_text(message_text(response)), "json"))
+    for data, method in candidates:
+        if not data:
+            continue
+        try:
+            return schema.model_validate(data), method
+        except ValidationError:
+            continue
+    return None, None
+
+
+# Incremental parser for a streamed JSON reply: feed() each chunk, then delta()
+# returns how much the string `field` has grown since the last call. feed()
+# reports the mode: "pending" until the first meaningful character, then "json",
+# or "text" when the reply isn't JSON after all.
+#
+# delta() only scans what arrived since the last call: it tracks nesting, keys and
+# string state of the top-level object and decodes the field's value as it goes
+# (an escape split across chunks waits for the next chunk), so a whole reply costs
+# one pass. Only the first occurrence of the field is streamed.
+_STRING_RUN = re.compile(r'[^"\\]+')
+_STRUCTURE = re.compile(r'[{}\[\]:,"]')
+_HIGH_SURROGATE = re.compile(r"\\u[dD][89abAB][0-9a-fA-F]{2}")
+
+
+class JsonFieldStream:
+    def __init__(self, field):
+        self.field = field
+        self.buffer = ""  # not yet scanned (in "pending" mode: everything so far)
+        self.mode = "pending"
+        self._parts = []  # decoded pieces of the field's value
+        self._sent = 0  # how many of _parts delta() has returned
+        self._depth = 0
+        self._string = None  # role of the string being read: "key", "value" (the field) or "other"
+        self._key = []  # the top-level key being read
+        self._last_key = None
+        self._expect = "key"  # at depth 1: "key" or "value"
+        self._done = False
+
+    @property
+    def emitted(self):
+        return "".join(self._parts)
+
+    def feed(self, text):
+        self.buffer += text
+        if self.mode == "pending":
+            head = self.buffer.lstrip()
+            if "```".startswith(head):
+                return self.mode
+            if head.startswith("```"):
+                if "\n" not in head:
+                    return self.mode
+                head = head.split("\n", 1)[1].lstrip()
+            if head:
+                self.mode = "json" if head.startswith("{") else "text"
+        return self.mode
+
+    def delta(self):
+        if not self._done:
+            self.buffer = self.buffer[self._scan(self.buffer):]
+        new = "".join(self._parts[self._sent:])
+        self._sent = len(self._parts)
+        return new
+
+    # Scan `text` from the start; returns how much of it was consumed
+    def _scan(self, text):
+        pos, end = 0, len(text)
+        while pos < end and not self._done:
+            if self._string is not None:
+                run = _STRING_RUN.match(text, pos)
+                if run:
+                    self._take(run.group())
+                    pos = run.end()
+                elif text[pos] == '"':
+                    self._end_string()
+                    pos += 1
+                else:  # backslash
+                    size = 12 if _HIGH_SURROGATE.match(text, pos) else 6 if text.startswith("\\u", pos) else 2
+                    if size == 12 and not text.startswith("\\u", pos + 6) and pos + 8 <= end:
+                        size = 6  # lone surrogate
+                    if pos + size > end:
+                        break  # the rest of the escape is in the next chunk
+                    try:
+                        self._take(json.loads(f'"{text[pos:pos + size]}"'))
+                    except ValueError:
+                        pass  # malformed escape: skip it
+                    pos += size
+                continue
+            match = _STRUCTURE.search(text, pos)
+            if match is None:
+                pos = end
+                break
+            pos = match.end()
+            char = match.group()
+            if char == '"':
+                if self._depth == 1 and self._expect == "key":
+                    self._string, self._key = "key", []
+                elif self._depth == 1 and self._last_key == self.field:
+                    self._string = "value"
+                else:
+                    self._string = "other"
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect = "key"
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth <= 0:
+                    self._done = True
+            elif self._depth == 1:
+                self._expect = "value" if char == ":" else "key"
+                if char == ",":
+                    self._last_key = None
+        return pos
+
+    def _take(self, chars):
+        if self._string == "value":
+            self._parts.append(chars)
+        elif self._string == "key":
+            self._key.append(chars)
+
+    def _end_string(self):
+        if self._string == "key":
+            self._last_key = "".join(self._key)
+        elif self._string == "value":
+            self._done = True
+        self._string = None
@@ -0,0 +1,5 @@
+# The server modules import each other as top-level modules (they run from api/)
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
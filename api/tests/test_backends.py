@@ -0,0 +1,26 @@
+import asyncio
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from backends import create_model
+
+
+def test_gemini_client_makes_a_single_attempt(monkeypatch):
+    monkeypatch.setenv("MODEL_BACKEND", "gemini")
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    model = create_model("gemini-1.5-flash")
+    calls = []
+
+    async def generate_content(**kwargs):
+        calls.append(kwargs.get("retry", "default"))
+        raise google_exceptions.ServiceUnavailable("overloaded")
+
+    async def scenario():
+        model.async_client_running = type("Client", (), {"generate_content": staticmethod(generate_content)})()
+        with pytest.raises(google_exceptions.ServiceUnavailable):
+            await model.ainvoke("hi")
+
+    asyncio.run(scenario())
+    # No tenacity retry, and the gRPC client's own retry is switched off
+    assert calls == [None]
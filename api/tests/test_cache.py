@@ -0,0 +1,21 @@
+from cache import SqliteCache
+
+
+def expired_rows(cache):
+    return cache._connect().execute("SELECT COUNT(*) FROM cache WHERE expires_at < strftime('%s', 'now')").fetchone()[0]
+
+
+def test_expired_rows_are_swept_every_n_writes(tmp_path):
+    cache = SqliteCache(str(tmp_path / "cache.db"), sweep_every=3, sweep_interval=3600)
+    cache.set("old", "value", ttl=-10)
+    cache.set("new", "value")
+    assert expired_rows(cache) == 1
+    cache.set("newer", "value")
+    assert expired_rows(cache) == 0
+    assert cache.get("new") == "value"
+
+
+def test_expiry_sweeps_use_an_index(tmp_path):
+    cache = SqliteCache(str(tmp_path / "cache.db"))
+    plan = cache._connect().execute("EXPLAIN QUERY PLAN DELETE FROM cache WHERE expires_at < 0").fetchall()
+    assert "cache_expires_at" in " ".join(str(row) for row in plan)
@@ -0,0 +1,88 @@
+import asyncio
+import zlib
+
+import pytest
+import zstandard
+
+from compression import CompressionMiddleware, negotiate
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("zstd, gzip", "zstd"),
+    ("gzip, deflate, br, zstd", "zstd"),
+    ("gzip;q=0.5, br", "gzip"),
+    ("zstd;q=0, gzip", "gzip"),
+    ("*", "zstd"),
+    ("*, zstd;q=0", "gzip"),
+    ("identity", None),
+    ("", None),
+])
+def test_negotiate(header, expected):
+    assert negotiate(header) == expected
+
+
+def make_app(chunks, content_type=b"application/json", extra_headers=()):
+    async def app(scope, receive, send):
+        headers = [(b"content-type", content_type), *extra_headers]
+        if len(chunks) == 1:
+            headers.append((b"content-length", str(len(chunks[0])).encode()))
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        for i, chunk in enumerate(chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": i < len(chunks) - 1})
+    return app
+
+
+def run(app, accept_encoding, min_size=100):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", accept_encoding.encode())]}
+    asyncio.run(CompressionMiddleware(app, min_size=min_size)(scope, None, send))
+    headers = {k.decode(): v.decode() for k, v in messages[0]["headers"]}
+    return headers, [m["body"] for m in messages[1:]]
+
+
+def decompressor(encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+BODY = b'{"essay": "' + b"chai and monsoon rain " * 50 + b'"}'
+
+
+@pytest.mark.parametrize("encoding", ["zstd", "gzip"])
+def test_large_bodies_are_compressed(encoding):
+    headers, bodies = run(make_app([BODY]), encoding)
+    assert headers["content-encoding"] == encoding
+    assert headers["vary"] == "Accept-Encoding"
+    assert int(headers["content-length"]) == len(bodies[0]) < len(BODY)
+    assert decompressor(encoding).decompress(bodies[0]) == BODY
+
+
+def test_identity_and_small_bodies_pass_through():
+    for accept_encoding, body in (("identity", BODY), ("zstd", b'{"ok": true}')):
+        headers, bodies = run(make_app([body]), accept_encoding)
+        assert "content-encoding" not in headers
+        assert bodies == [body]
+
+
+@pytest.mark.parametrize("encoding", ["zstd", "gzip"])
+def test_streamed_chunks_are_flushed_one_by_one(encoding):
+    lines = [b'{"event": "token", "text": "line %d"}\n' % i for i in range(5)]
+    headers, bodies = run(make_app(lines, content_type=b"application/x-ndjson"), encoding)
+    assert headers["content-encoding"] == encoding
+    assert "content-length" not in headers
+    decoder = decompressor(encoding)
+    # Every compressed chunk decodes to its line before the next one arrives
+    assert [decoder.decompress(body) for body in bodies] == lines
+
+
+def test_already_encoded_and_other_types_are_skipped():
+    encoded = [(b"content-encoding", b"br")]
+    for app in (make_app([BODY], extra_headers=encoded), make_app([BODY], content_type=b"text/event-stream")):
+        headers, bodies = run(app, "zstd, gzip")
+        assert headers.get("content-encoding") in (None, "br")
+        assert bodies == [BODY]
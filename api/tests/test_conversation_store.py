@@ -0,0 +1,53 @@
+import threading
+
+import pytest
+
+from conversation_store import ConversationStore
+
+
+def test_concurrent_appends_keep_every_turn(tmp_path):
+    store = ConversationStore(str(tmp_path / "conversations.db"))
+    first, second = store.create(), store.create()
+    errors = []
+
+    def append_many(conv_id):
+        try:
+            for i in range(100):
+                store.append(conv_id, {"prompt": f"p{i}", "answer": f"a{i}"})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=append_many, args=(conv_id,)) for conv_id in (first, second, first, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert store.turns(first) == store.turns(second) == 200
+    assert len(store.load(first)) == 200
+
+
+def test_interrupted_migration_is_retried_whole(tmp_path, monkeypatch):
+    conv_dir = tmp_path / "conversations"
+    conv_dir.mkdir()
+    (conv_dir / "5.txt").write_text("PROMPT: hi\nANSWER: yo\nCONTEXT: c\n\nPROMPT: again\nANSWER: x\n", encoding="utf-8")
+    store = ConversationStore(str(tmp_path / "conversations.db"))
+
+    append = store._append
+    calls = []
+
+    def failing_append(conn, conv_id, exchange):
+        calls.append(conv_id)
+        if len(calls) == 2:
+            raise RuntimeError("interrupted")
+        append(conn, conv_id, exchange)
+
+    monkeypatch.setattr(store, "_append", failing_append)
+    with pytest.raises(RuntimeError):
+        store.migrate_text_dir(str(conv_dir))
+    assert store.list() == []
+
+    monkeypatch.setattr(store, "_append", append)
+    assert store.migrate_text_dir(str(conv_dir)) == 1
+    assert store.list() == [{"id": 5, "title": "hi", "turns": 2}]
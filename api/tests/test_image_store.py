@@ -0,0 +1,23 @@
+from image_store import ImageStore
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    def get(self, url, timeout=None):
+        return FakeResponse(url.encode("utf-8"))
+
+
+def test_prompt_is_found_again_when_fewer_images_came_back(tmp_path):
+    store = ImageStore(str(tmp_path))
+    store.session = FakeSession()
+    images = [{"image_url": "https://example.com/1.jpg"}, {"image_url": "https://example.com/2.jpg"}]
+    paths = store.fetch_all("Chai  at dawn", images, num_images=3)
+    assert store.lookup_prompt("chai at dawn", 3) == paths
+    assert store.lookup_prompt("chai at dawn", 2) is None
@@ -0,0 +1,62 @@
+import asyncio
+import multiprocessing
+import os
+
+from memory import ConversationMemory
+from retrieval import HashingEmbedder, RetrievalMemory
+
+
+def test_cached_states_are_bounded_and_reread_from_disk(tmp_path):
+    memory = ConversationMemory(str(tmp_path), max_cached=2)
+
+    async def scenario():
+        for conv_id in ("a", "b", "c"):
+            await memory.append(conv_id, f"summary of {conv_id}")
+        memory.load("b")
+        await memory.append("d", "summary of d")
+
+    asyncio.run(scenario())
+    assert list(memory._states) == ["b", "d"]
+    assert set(memory._mtimes) == {"b", "d"}
+    assert memory.load("a")["recent"] == ["summary of a"]
+    assert len(memory._states) == 2
+
+
+def test_retrieval_indexes_are_bounded(tmp_path):
+    memory = RetrievalMemory(str(tmp_path), HashingEmbedder(dim=32), max_cached=2)
+    for conv_id in ("a", "b", "c"):
+        memory.add(conv_id, [f"summary of {conv_id}"])
+    assert list(memory._indexes) == ["b", "c"]
+    assert set(memory._sizes) == {"b", "c"}
+    assert memory.search("a", "summary of a", k=1) == ["summary of a"]
+    assert list(memory._indexes) == ["c", "a"]
+
+
+def append_from_worker(directory, worker):
+    memory = ConversationMemory(os.path.join(directory, "memory"))
+    retrieval = RetrievalMemory(os.path.join(directory, "vectors"), HashingEmbedder(dim=32))
+
+    async def scenario():
+        for i in range(25):
+            await memory.append("shared", f"worker {worker} turn {i}")
+            retrieval.add("shared", [f"worker {worker} turn {i}"])
+
+    asyncio.run(scenario())
+
+
+def test_worker_processes_can_share_the_memory(tmp_path):
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=append_from_worker, args=(str(tmp_path), n)) for n in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    memory = ConversationMemory(str(tmp_path / "memory"))
+    assert memory.load("shared")["turns"] == 75
+    retrieval = RetrievalMemory(str(tmp_path / "vectors"), HashingEmbedder(dim=32))
+    assert retrieval.count("shared") == 75
+    # Every vector still sits next to its own text
+    for text in ("worker 0 turn 7", "worker 2 turn 24"):
+        assert retrieval.search("shared", text, k=1) == [text]
@@ -0,0 +1,37 @@
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from metrics import classify_error
+from resilience import UpstreamTimeout
+from scheduler import SchedulerBusy
+
+
+class WrappedError(Exception):
+    pass
+
+
+def wrapped(cause):
+    try:
+        raise WrappedError(str(cause)) from cause
+    except WrappedError as e:
+        return e
+
+
+@pytest.mark.parametrize("exc, category", [
+    (google_exceptions.ResourceExhausted("quota"), "upstream_rate_limited"),
+    (wrapped(google_exceptions.ResourceExhausted("quota")), "upstream_rate_limited"),
+    (google_exceptions.DeadlineExceeded("slow"), "upstream_timeout"),
+    (UpstreamTimeout("deadline"), "upstream_timeout"),
+    (google_exceptions.ServiceUnavailable("down"), "upstream_error"),
+    (wrapped(google_exceptions.InvalidArgument("API key not valid. Please pass a valid API key.")), "invalid_api_key"),
+    (SchedulerBusy(2), "server_busy"),
+])
+def test_classify_error_by_upstream_status(exc, category):
+    assert classify_error(exc) == category
+
+
+# Numbers or words in the message don't decide the category
+def test_classify_error_ignores_message_text():
+    assert classify_error(ValueError("expected 429 items, got 12")) == "upstream_error"
+    assert classify_error(ValueError("Timeout field missing from reply")) == "upstream_error"
+    assert classify_error(google_exceptions.InternalServerError("429 Too Many Requests")) == "upstream_error"
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from resilience import ResilientCaller, RetryBudget, UpstreamTimeout, is_retryable, upstream_status
+from scheduler import SchedulerBusy
+
+
+def make_caller(**kwargs):
+    kwargs.setdefault("base_delay", 0.001)
+    kwargs.setdefault("max_delay", 0.001)
+    return ResilientCaller(**kwargs)
+
+
+# An attempt that raises the given errors in turn, then returns "ok"
+def failing(*errors):
+    calls = []
+
+    async def attempt():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "ok"
+
+    return attempt, calls
+
+
+def test_timeout_raised_by_the_attempt_is_retried():
+    caller = make_caller(deadline=5.0)
+    attempt, calls = failing(TimeoutError("read timed out"))
+    assert asyncio.run(caller.call(attempt)) == "ok"
+    assert len(calls) == 2
+    assert caller.stats["retries"] == 1
+    assert caller.stats["deadline_exceeded"] == 0
+
+
+def test_deadline_cancels_the_attempt():
+    caller = make_caller(deadline=0.05)
+    cancelled = []
+
+    async def attempt():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    with pytest.raises(UpstreamTimeout, match="0.1s deadline"):
+        asyncio.run(caller.call(attempt))
+    assert cancelled == [1]
+    assert caller.stats["deadline_exceeded"] == 1
+
+
+def test_retryable_upstream_errors_are_retried_up_to_max_retries():
+    caller = make_caller(max_retries=2)
+    attempt, calls = failing(*[google_exceptions.ServiceUnavailable("overloaded")] * 3)
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        asyncio.run(caller.call(attempt))
+    assert len(calls) == 3
+
+
+def test_non_retryable_errors_are_raised_at_once():
+    caller = make_caller()
+    attempt, calls = failing(google_exceptions.InvalidArgument("API key not valid"))
+    with pytest.raises(google_exceptions.InvalidArgument):
+        asyncio.run(caller.call(attempt))
+    assert len(calls) == 1
+
+
+def test_retries_stop_when_the_budget_is_empty():
+    caller = make_caller(budget=RetryBudget(capacity=0))
+    attempt, calls = failing(google_exceptions.TooManyRequests("slow down"))
+    with pytest.raises(google_exceptions.TooManyRequests):
+        asyncio.run(caller.call(attempt))
+    assert len(calls) == 1
+    assert caller.stats["budget_exhausted"] == 1
+
+
+@pytest.mark.parametrize("exc, expected", [
+    (google_exceptions.TooManyRequests("quota"), True),
+    (google_exceptions.InternalServerError("oops"), True),
+    (google_exceptions.DeadlineExceeded("slow"), True),
+    (google_exceptions.InvalidArgument("bad request"), False),
+    (ConnectionResetError(), True),
+    (TimeoutError(), True),
+    (SchedulerBusy(500, "rate limited"), False),
+    (RuntimeError("failed after 1500 tokens, HTTP 503 in the text"), False),
+])
+def test_is_retryable_uses_the_status_not_the_message(exc, expected):
+    assert is_retryable(exc) is expected
+
+
+def test_upstream_status_follows_wrapped_errors():
+    try:
+        try:
+            raise google_exceptions.ResourceExhausted("quota")
+        except google_exceptions.ResourceExhausted as e:
+            raise RuntimeError("chat model failed") from e
+    except RuntimeError as wrapped:
+        assert upstream_status(wrapped) == 429
+        assert is_retryable(wrapped)
@@ -0,0 +1,181 @@
+import asyncio
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+import scheduler as scheduler_module
+from scheduler import BULK, INTERACTIVE, SchedulerBusy, SharedWindow, TokenBucket, UpstreamScheduler, is_rate_limited
+from shared_state import LocalRedis, RedisStore
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_permits_are_granted_up_to_the_window():
+    async def scenario():
+        scheduler = UpstreamScheduler(max_concurrency=2)
+        first = await scheduler.acquire()
+        await scheduler.acquire()
+        third = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0)
+        assert not third.done() and scheduler.queue_depth() == 1
+        scheduler.release(first)
+        await asyncio.wait_for(third, 1)
+        assert scheduler.in_flight == 2
+
+    run(scenario())
+
+
+def test_interactive_waiters_go_before_bulk():
+    async def scenario():
+        scheduler = UpstreamScheduler(max_concurrency=1)
+        held = await scheduler.acquire()
+        order = []
+
+        async def wait(priority, name):
+            permit = await scheduler.acquire(priority)
+            order.append(name)
+            scheduler.release(permit)
+
+        tasks = [asyncio.ensure_future(wait(BULK, "bulk")), asyncio.ensure_future(wait(INTERACTIVE, "interactive"))]
+        await asyncio.sleep(0)
+        scheduler.release(held)
+        await asyncio.gather(*tasks)
+        assert order == ["interactive", "bulk"]
+
+    run(scenario())
+
+
+def test_full_queue_is_rejected():
+    async def scenario():
+        scheduler = UpstreamScheduler(max_concurrency=1, max_queue=1)
+        await scheduler.acquire()
+        waiter = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerBusy):
+            await scheduler.acquire()
+        assert scheduler.stats["rejected"] == 1
+        waiter.cancel()
+
+    run(scenario())
+
+
+def test_queue_timeout_raises_busy():
+    async def scenario():
+        scheduler = UpstreamScheduler(max_concurrency=1, queue_timeout=0.01)
+        await scheduler.acquire()
+        with pytest.raises(SchedulerBusy, match="queue timeout"):
+            await scheduler.acquire()
+        assert scheduler.queue_depth() == 0
+
+    run(scenario())
+
+
+def test_cancelled_waiter_does_not_leak_a_permit():
+    async def scenario():
+        scheduler = UpstreamScheduler(max_concurrency=1)
+        held = await scheduler.acquire()
+        waiter = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        scheduler.release(held)
+        assert scheduler.in_flight == 0
+        assert scheduler.queue_depth() == 0
+
+    run(scenario())
+
+
+def test_rate_limit_halves_the_window_and_success_grows_it():
+    async def scenario():
+        scheduler = UpstreamScheduler(max_concurrency=8)
+        permit = await scheduler.acquire()
+        scheduler.release(permit, error=google_exceptions.TooManyRequests("quota"))
+        assert scheduler.limit == 4
+        for _ in range(4):
+            permit = await scheduler.acquire()
+            scheduler.release(permit, latency=0.1)
+        assert scheduler.limit > 4
+
+    run(scenario())
+
+
+def test_latency_spike_shrinks_the_window():
+    async def scenario():
+        scheduler = UpstreamScheduler(max_concurrency=8, spike_factor=3.0)
+        for latency in (0.1, 0.1, 1.0):
+            permit = await scheduler.acquire()
+            scheduler.release(permit, latency=latency)
+        assert scheduler.stats["decreases"] == 1
+        assert scheduler.limit < 8
+
+    run(scenario())
+
+
+def test_release_without_latency_leaves_the_baseline_alone():
+    async def scenario():
+        scheduler = UpstreamScheduler(max_concurrency=4)
+        permit = await scheduler.acquire()
+        scheduler.release(permit)
+        assert scheduler.baseline_latency is None
+
+    run(scenario())
+
+
+def test_requests_per_minute_limit_delays_dispatch():
+    async def scenario():
+        scheduler = UpstreamScheduler(max_concurrency=4, rpm=1)
+        await scheduler.acquire()
+        waiter = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+    run(scenario())
+
+
+def test_token_bucket_wait_time():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.wait_time(10) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0, abs=0.05)
+    bucket.adjust(30)
+    assert bucket.wait_time(10) == 0
+
+
+def test_shared_window_slides_over_the_minute_boundary(monkeypatch):
+    now = [599.5]
+    monkeypatch.setattr(scheduler_module.time, "time", lambda: now[0])
+    window = SharedWindow(RedisStore(LocalRedis()), "requests", per_minute=10)
+    window.take(10)
+    assert window.wait_time(1) == pytest.approx(0.5)
+    window.sync()
+    # Just past the boundary the previous minute still counts almost in full
+    now[0] = 603.0
+    assert window.wait_time(1) == pytest.approx(3)
+    now[0] = 630.0
+    assert window.wait_time(5) == 0
+
+
+def test_shared_window_counts_other_workers_after_a_sync(monkeypatch):
+    monkeypatch.setattr(scheduler_module.time, "time", lambda: 630.0)
+    store = RedisStore(LocalRedis())
+    first = SharedWindow(store, "requests", per_minute=10)
+    second = SharedWindow(store, "requests", per_minute=10)
+    first.take(10)
+    assert second.wait_time(1) == 0
+    first.sync()
+    second.sync()
+    assert second.wait_time(1) > 0
+    first.adjust(5)
+    first.sync()
+    second.sync()
+    assert second.wait_time(1) == 0
+
+
+def test_is_rate_limited_uses_the_status():
+    assert is_rate_limited(google_exceptions.ResourceExhausted("quota"))
+    assert not is_rate_limited(SchedulerBusy(429))
+    assert not is_rate_limited(RuntimeError("processed 429 items"))
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def slow_call(calls, delay=0.1):
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return "result"
+    return fn
+
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flight, calls = SingleFlight(), []
+        results = await asyncio.gather(*(flight.do("k", slow_call(calls)) for _ in range(3)))
+        assert results == ["result"] * 3
+        assert calls == [1]
+        assert flight.stats == {"leaders": 1, "followers": 2}
+        assert flight.in_flight() == 0
+
+    asyncio.run(scenario())
+
+
+def test_follower_timeout_only_ends_its_own_wait():
+    async def scenario():
+        flight, calls = SingleFlight(), []
+        leader = asyncio.ensure_future(flight.do("k", slow_call(calls)))
+        await asyncio.sleep(0)
+        with pytest.raises(TimeoutError):
+            await flight.do("k", slow_call(calls), timeout=0.02)
+        assert await leader == "result"
+        assert calls == [1]
+
+    asyncio.run(scenario())
+
+
+def test_leader_timeout_does_not_cancel_the_shared_call():
+    async def scenario():
+        flight, calls = SingleFlight(), []
+        leader = asyncio.ensure_future(flight.do("k", slow_call(calls), timeout=0.02))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("k", slow_call(calls)))
+        with pytest.raises(TimeoutError):
+            await leader
+        assert await follower == "result"
+        assert calls == [1]
+
+    asyncio.run(scenario())
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+from langchain_core.messages import AIMessage
+
+from structured import CompanionReply, JsonFieldStream, parse_structured
+
+REPLY = {"answer": 'Chai is "tea" \\ brewed\nwith milk – é \U0001f375', "summary": "Chai explained in a few words."}
+
+
+def stream(text, field="answer", size=3):
+    parser = JsonFieldStream(field)
+    pieces = []
+    for i in range(0, len(text), size):
+        if parser.feed(text[i:i + size]) == "json":
+            pieces.append(parser.delta())
+    return parser, pieces
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, 1000])
+def test_field_is_streamed_in_order_whatever_the_chunking(size):
+    parser, pieces = stream(json.dumps(REPLY), size=size)
+    assert "".join(pieces) == REPLY["answer"]
+    assert parser.emitted == REPLY["answer"]
+
+
+def test_escapes_split_across_chunks_are_decoded():
+    text = json.dumps(REPLY)  # ensure_ascii: é and a surrogate pair for the emoji
+    assert "\\ud83c" in text
+    for cut in range(len(text)):
+        parser = JsonFieldStream("answer")
+        parser.feed(text[:cut])
+        first = parser.delta()
+        parser.feed(text[cut:])
+        assert first + parser.delta() == REPLY["answer"]
+
+
+def test_fenced_json_is_streamed():
+    parser, pieces = stream("```json\n" + json.dumps(REPLY, ensure_ascii=False) + "\n```")
+    assert parser.mode == "json"
+    assert "".join(pieces) == REPLY["answer"]
+
+
+def test_summary_first_and_nested_values_are_skipped():
+    reply = {"summary": "answer: no", "meta": {"answer": "nested", "list": ["{", "answer"]}, "answer": "the real one"}
+    parser, pieces = stream(json.dumps(reply))
+    assert "".join(pieces) == "the real one"
+
+
+def test_plain_text_reply_switches_to_text_mode():
+    parser = JsonFieldStream("answer")
+    assert parser.feed("  ") == "pending"
+    assert parser.feed("Chai is tea.") == "text"
+
+
+def test_parse_structured_prefers_the_parsed_result():
+    parsed = CompanionReply(**REPLY)
+    assert parse_structured({"raw": AIMessage(content=""), "parsed": parsed}, CompanionReply) == (parsed, "structured")
+
+
+def test_parse_structured_reads_tool_calls():
+    message = AIMessage(content="", tool_calls=[{"name": "CompanionReply", "args": REPLY, "id": "1"}])
+    reply, method = parse_structured({"raw": message, "parsed": None}, CompanionReply)
+    assert (reply.answer, method) == (REPLY["answer"], "structured")
+
+
+@pytest.mark.parametrize("content", [
+    "```json\n" + json.dumps(REPLY) + "\n```",
+    "Sure! Here it is: " + json.dumps(REPLY),
+    json.dumps(REPLY)[:-1],  # cut off before the closing brace
+])
+def test_parse_structured_finds_json_in_the_text(content):
+    reply, method = parse_structured(AIMessage(content=content), CompanionReply)
+    assert method == "json"
+    assert reply.answer == REPLY["answer"]
+    assert reply.summary == REPLY["summary"]
+
+
+@pytest.mark.parametrize("content", ["Chai is tea.\nSUMMARY: about chai", '{"answer": "no summary"}'])
+def test_parse_structured_leaves_other_replies_to_the_fallback(content):
+    assert parse_structured(AIMessage(content=content), CompanionReply) == (None, None)
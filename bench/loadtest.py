@@ -0,0 +1,188 @@
+# Load-test harness for api/app.py.
+# By default the app runs in-process on the fake model backend (MODEL_BACKEND=fake),
+# so no API key or quota is used. Each scenario is driven at fixed concurrency
+# levels and the throughput, p50/p95/p99 latency and event-loop lag are written
+# to bench/results/<timestamp>-<commit>.json for comparison across commits.
+#
+#   python bench/loadtest.py --concurrency 1,8,32 --requests 200
+#   python bench/loadtest.py --url http://localhost:8000   # against a running server
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_DIR = os.path.join(ROOT, "api")
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+counter = itertools.count()
+
+
+# Each scenario builds one request; topics are unique so every call reaches the model
+SCENARIOS = {
+    "essay": lambda: ("GET", "/essay", {"topic": f"monsoon {next(counter)}", "length": 100, "no_cache": "true"}),
+    "poem": lambda: ("GET", "/poem", {"topic": f"chai {next(counter)}", "length": 30, "no_cache": "true"}),
+    "companion": lambda: ("POST", "/companion", {"prompt": f"Tell me about Diwali ({next(counter)})"}),
+    "generate-image": lambda: ("GET", "/generate-image", {"prompt": f"a cat on a roof {next(counter)}", "num_images": 3}),
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+# Samples how late the event loop wakes up from a short sleep while the load runs
+class LoopLagMonitor:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval) * 1000)
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def ok_response(response):
+    if response.status_code != 200:
+        return False
+    data = response.json()
+    return "error" not in data and "API ERROR From Server" not in json.dumps(data)
+
+
+async def run_level(client, scenario, concurrency, total):
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(SCENARIOS[scenario]())
+
+    async def worker():
+        nonlocal errors
+        while True:
+            try:
+                method, path, params = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, params=params)
+                if not ok_response(response):
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    lag = LoopLagMonitor()
+    lag.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await lag.stop()
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2),
+        "latency_ms": {
+            "mean": round(statistics.mean(latencies), 2),
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(max(latencies), 2),
+        },
+        "loop_lag_ms": {
+            "p50": round(percentile(lag.samples, 50) or 0, 2),
+            "p99": round(percentile(lag.samples, 99) or 0, 2),
+            "max": round(max(lag.samples, default=0), 2),
+        },
+    }
+
+
+def make_client(url, timeout):
+    if url:
+        return httpx.AsyncClient(base_url=url, timeout=timeout)
+    # In-process: the app shares this event loop, so loop lag includes server work
+    sys.path.insert(0, API_DIR)
+    os.chdir(API_DIR)
+    os.environ.setdefault("MODEL_BACKEND", "fake")
+    os.environ.setdefault("GOOGLE_API_KEY", "fake")
+    import app
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://bench", timeout=timeout)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+async def main(args):
+    results = []
+    async with make_client(args.url, args.timeout) as client:
+        for scenario in args.scenarios.split(","):
+            for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                result = await run_level(client, scenario, concurrency, args.requests)
+                results.append(result)
+                lat = result["latency_ms"]
+                print(f"{scenario:15} c={concurrency:<4} {result['throughput_rps']:>8} req/s  "
+                      f"p50={lat['p50']:>8}ms p95={lat['p95']:>8}ms p99={lat['p99']:>8}ms  "
+                      f"lag p99={result['loop_lag_ms']['p99']}ms  errors={result['errors']}")
+
+    commit = git_commit()
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "target": args.url or "in-process",
+        "backend": os.getenv("MODEL_BACKEND", "gemini") if args.url is None else "remote",
+        "fake_model": {k: os.getenv(k) for k in ("FAKE_LATENCY_MS", "FAKE_LATENCY_SIGMA", "FAKE_TOKENS_PER_SEC", "FAKE_FAILURE_RATE")},
+        "python": platform.python_version(),
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{commit or 'nogit'}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the API endpoints against the fake or a live backend")
+    parser.add_argument("--url", default=None, help="Base URL of a running server (default: run the app in-process)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per scenario and concurrency level")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", default=None, help="Result file (default: bench/results/<timestamp>-<commit>.json)")
+    asyncio.run(main(parser.parse_args()))
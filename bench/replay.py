@@ -0,0 +1,145 @@
+# Replays a traffic capture (api/capture.py, CAPTURE=1) against the server.
+# Requests are sent at their original arrival offsets, or --speed times faster,
+# so production load shapes (bursts, repeats, mixes of endpoints) can be
+# reproduced against the fake backend and the effect of cache or scheduler
+# changes measured on real traffic. Like loadtest.py the app runs in-process on
+# MODEL_BACKEND=fake unless --url is given; results go to bench/results/.
+#
+#   python bench/replay.py storage/capture.jsonl --speed 10
+#   python bench/replay.py storage/capture.jsonl --url http://localhost:8000
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import httpx
+
+from loadtest import RESULTS_DIR, git_commit, make_client, percentile
+
+
+def load_capture(path, limit=None):
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    records.sort(key=lambda record: record["ts"])
+    # Truncated bodies can't be sent again
+    records = [record for record in records if not record.get("body_truncated")]
+    return records[:limit] if limit else records
+
+
+def latency_summary(values):
+    if not values:
+        return {}
+    return {
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "max": round(max(values), 2),
+    }
+
+
+async def send(client, record):
+    path = record["path"] + (f"?{record['query']}" if record["query"] else "")
+    headers = {"content-type": "application/json"} if record.get("body") else {}
+    start = time.perf_counter()
+    try:
+        response = await client.request(record["method"], path, content=record.get("body") or None, headers=headers)
+        await response.aread()
+        status = response.status_code
+    except httpx.HTTPError:
+        status = None
+    return record, status, (time.perf_counter() - start) * 1000
+
+
+async def replay(client, records, speed):
+    origin = records[0]["ts"]
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    tasks = []
+    for record in records:
+        delay = (record["ts"] - origin) / speed - (loop.time() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(client, record)))
+    results = await asyncio.gather(*tasks)
+    return results, loop.time() - started
+
+
+def report(results, elapsed):
+    by_endpoint = {}
+    for record, status, latency in results:
+        by_endpoint.setdefault(record.get("endpoint") or record["path"], []).append((record, status, latency))
+    endpoints = {}
+    for endpoint, rows in sorted(by_endpoint.items()):
+        endpoints[endpoint] = {
+            "requests": len(rows),
+            "status": dict(Counter(str(status) for _, status, _ in rows)),
+            "status_changed": sum(1 for record, status, _ in rows if status != record["status"]),
+            "latency_ms": latency_summary([latency for _, _, latency in rows]),
+            "original_latency_ms": latency_summary([record["duration_ms"] for record, _, _ in rows]),
+        }
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, status, _ in results if status is None or status >= 500),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(results) / elapsed, 2) if elapsed else None,
+        "latency_ms": latency_summary([latency for _, _, latency in results]),
+        "endpoints": endpoints,
+    }
+
+
+async def main(args):
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        print("No requests to replay")
+        return
+    span = records[-1]["ts"] - records[0]["ts"]
+    print(f"Replaying {len(records)} requests spanning {span:.1f}s at {args.speed}x")
+    # Don't record the replay itself when the app runs in-process
+    os.environ["CAPTURE"] = "0"
+    async with make_client(args.url, args.timeout) as client:
+        results, elapsed = await replay(client, records, args.speed)
+    summary = report(results, elapsed)
+
+    for endpoint, data in summary["endpoints"].items():
+        lat, orig = data["latency_ms"], data["original_latency_ms"]
+        print(f"{endpoint:30} n={data['requests']:<5} p50={lat['p50']:>8}ms (was {orig['p50']}) "
+              f"p95={lat['p95']:>8}ms (was {orig['p95']})  status changed={data['status_changed']}")
+    print(f"total: {summary['throughput_rps']} req/s over {summary['elapsed_s']}s, errors={summary['errors']}")
+
+    commit = git_commit()
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{commit or 'nogit'}-replay.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": commit,
+            "capture": os.path.abspath(args.capture),
+            "speed": args.speed,
+            "target": args.url or "in-process",
+            **summary,
+        }, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a captured traffic file against the API server")
+    parser.add_argument("capture", help="Capture file written with CAPTURE=1 (JSONL)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay N times faster than the original timing")
+    parser.add_argument("--url", default=None, help="Base URL of a running server (default: run the app in-process)")
+    parser.add_argument("--limit", type=int, default=None, help="Only replay the first N requests")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", default=None, help="Result file (default: bench/results/<timestamp>-<commit>-replay.json)")
+    args = parser.parse_args()
+    # make_client() changes into api/ for the in-process app
+    args.capture = os.path.abspath(args.capture)
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    asyncio.run(main(args))